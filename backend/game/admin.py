@@ -5,7 +5,7 @@ from django.contrib import admin
 from django.http.request import HttpRequest
 from django_admin_inline_paginator.admin import TabularInlinePaginated
 
-from .models import Topic, Entity, TopicEntity, Player, Round, Answer
+from .models import Topic, Entity, TopicEntity, Player, Round, Answer, Job
 
 
 class TopicEntityInline(admin.TabularInline):
@@ -30,6 +30,11 @@ class TopicAdmin(admin.ModelAdmin):
     list_display = ['title', 'average_score', 'average_score_hits_mode']
     search_fields = ['title']
 
+    def delete_queryset(self, request: HttpRequest, queryset: Any) -> None:
+        # Bulk deletion skips Topic.delete, which drops the prepared offers
+        for topic in queryset:
+            topic.delete()
+
     def save_formset(self, request: Any, form: Any, formset: Any, change: Any) -> None:
         if formset.model != TopicEntity:
             return super().save_formset(request, form, formset, change)
@@ -65,13 +70,17 @@ class TopicEntityAdmin(admin.ModelAdmin):
 
     def save_model(self, request: Any, obj: TopicEntity, form: Any, change: Any) -> None:
         super().save_model(request, obj, form, change)
-        obj.topic.gather_matches()
+        if change and ('topic' in form.changed_data or 'entity' in form.changed_data):
+            previous_topic = Topic.objects.get(id=form.initial['topic'])
+            previous_topic.remove_entity_matches(form.initial['entity'])
+            previous_topic.update_entities_positions()
+        obj.topic.update_entity_matches(obj.entity)
         obj.topic.update_entities_positions()
 
     def delete_model(self, request: HttpRequest, obj: TopicEntity) -> None:
         topic = obj.topic
         super().delete_model(request, obj)
-        topic.gather_matches()
+        topic.remove_entity_matches(obj.entity_id)
         topic.update_entities_positions()
 
 
@@ -97,11 +106,15 @@ class PlayerAdmin(admin.ModelAdmin):
     readonly_fields = [
         'telegram_id', 'telegram_username', 'name', 'victories', 'defeats', 'draws', 'average_score', 'rating', 
         'best_rating', 'best_rating_reached_at', 'level', 'duel_victories', 'duel_defeats', 'duel_draws',
-        'duel_average_score', 'duel_rating', 'assigned_topics'
+        'duel_average_score', 'duel_rating', 'assigned_topics', 'played_topics'
     ]
     search_fields = ['telegram_username', 'name']
     list_filter = ['level']
 
+    def save_model(self, request: Any, obj: Player, form: Any, change: Any) -> None:
+        # Only the edited fields, so the counters and played topics changed meanwhile are kept
+        obj.save(update_fields=form.changed_data if change else None)
+
 
 @admin.register(Round)
 class RoundAdmin(admin.ModelAdmin):
@@ -112,7 +125,7 @@ class RoundAdmin(admin.ModelAdmin):
     list_filter = ['started_at', 'finished_at']
     readonly_fields = [
         'player1', 'player2', 'topic', 'duel', 'hits_mode', 'score1', 'score2', 'hits1', 'hits2', 'player1_answers',
-        'player2_answers', 'finished_at', 'bot_answers', 'feedback1', 'feedback2'
+        'player2_answers', 'finished_at', 'used_topic_entities', 'feedback1', 'feedback2'
     ]
 
 
@@ -130,3 +143,10 @@ class AnswerAdmin(admin.ModelAdmin):
     search_fields = ['text', 'topic_entity__topic__title', 'topic_entity__entity__title']
 
     form = AnswerAdminForm
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ['name', 'args', 'run_after', 'attempts', 'failed']
+    list_filter = ['name', 'failed']
+    readonly_fields = ['name', 'key', 'args', 'created_at', 'attempts', 'error']
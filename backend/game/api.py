@@ -1,7 +1,9 @@
 from typing import Optional
 
+from django.db import transaction
 from django.shortcuts import get_object_or_404
 from ninja import Router, Field, Schema
+from .matching import get_negative_cache_stats
 from .models import Topic, Entity, TopicEntity, Player, Round, Answer, Config
 
 router = Router()
@@ -11,6 +13,10 @@ class Message200(Schema):
     detail: str
 
 
+class Message400(Schema):
+    detail: str
+
+
 class Message403(Schema):
     detail: str
 
@@ -36,22 +42,22 @@ def get_random_topics(request, player1_id: int = 0, player2_id: int = 0):
     if not player2_id:
         if player1.assigned_topics:
             return list(Topic.objects.assigned_to(player1))
-        topics = Topic.objects.exclude_played_by(player1)
-        if not topics:
-            return 403, {'detail': 'Не осталось доступных тем для данного игрока'}
-        random_topics = topics.for_level(player1.level).random(Config.topics_count)
-        if random_topics.count() < Config.topics_count:
-            random_topics = topics.random(Config.topics_count)
+        random_topics = player1.pop_topic_offer()
+        if random_topics is None:
+            random_topics = Topic.get_random(Config.topics_count, player1.get_played_topic_ids(), [player1.level])
+            if not random_topics:
+                return 403, {'detail': 'Не осталось доступных тем для данного игрока'}
         player1.assign_topics(random_topics)
-        return list(random_topics)
+        return random_topics
     player2 = Player.find_or_create(player_id=player2_id)
-    topics = Topic.objects.exclude_played_by(player1).exclude_played_by(player2)
-    if not topics:
+    random_topics = Topic.get_random(
+        Config.topics_count,
+        player1.get_played_topic_ids() | player2.get_played_topic_ids(),
+        [player1.level, player2.level]
+    )
+    if not random_topics:
         return 403, {'detail': 'Не осталось доступных тем для данной пары игроков'}
-    random_topics = topics.for_level(player1.level).for_level(player2.level).random(Config.topics_count)
-    if random_topics.count() < Config.topics_count:
-        random_topics = topics.random(Config.topics_count)
-    return list(random_topics)
+    return random_topics
 
 
 class EntitySchema(Schema):
@@ -87,12 +93,25 @@ def get_players(request, group: Optional[str] = None):
     return Player.objects.all()
 
 
-# TODO duel rating
+class DuelPlayerOutSchema(Schema):
+    id: int
+    telegram_id: int
+    displayed_name: str
+    name_with_id: str
+    rating: int = Field(0, alias='duel_rating')
+    position: int = Field(None, alias='duel_position')
+
+
 @router.get('/rating', response={200: list[PlayerOutSchema]})
 def get_rating(request):
     return Player.objects.top(10)
 
 
+@router.get('/duel-rating', response={200: list[DuelPlayerOutSchema]})
+def get_duel_rating(request):
+    return Player.objects.top(10, field='duel_rating')
+
+
 @router.post('/player', response={200: PlayerOutSchema})
 def find_player(request, data: PlayerInSchema):
     if not data.telegram_username:
@@ -117,7 +136,7 @@ def put_player(request, data: ReferrerSchema):
     player = Player.find_or_create(player_id=data.player_id)
     if not player.referrer:
         player.referrer = Player.find_or_create(player_id=data.referrer_id)
-        player.save()
+        player.save(update_fields=['referrer'])
     return {'detail': 'ok'}
 
 
@@ -138,21 +157,28 @@ def start_round(request, data: RoundInSchema):
     player1 = Player.find_or_create(player_id=data.player1_id)
     if not data.player2_id:
         player1.clear_assigned_topics()
-        round, created = Round.objects.get_or_create(player1=player1, topic_id=data.topic_id, hits_mode=data.hits_mode)
-        if created:
-            round.update_bot_answers()
-            return {'id': round.id}
+        with transaction.atomic():
+            round, created = Round.objects.get_or_create(
+                player1=player1,
+                topic_id=data.topic_id,
+                hits_mode=data.hits_mode
+            )
+            if created:
+                round.add_to_played_topics()
+                return {'id': round.id}
         return 403, {'detail': 'Тема уже сыграна'}
     player2 = Player.find_or_create(player_id=data.player2_id)
-    round, created = Round.objects.get_or_create(
-        player1=player1,
-        player2=player2,
-        topic_id=data.topic_id,
-        hits_mode=data.hits_mode,
-        duel=True
-    )
-    if created:
-        return {'id': round.id}
+    with transaction.atomic():
+        round, created = Round.objects.get_or_create(
+            player1=player1,
+            player2=player2,
+            topic_id=data.topic_id,
+            hits_mode=data.hits_mode,
+            duel=True
+        )
+        if created:
+            round.add_to_played_topics()
+            return {'id': round.id}
     return 403, {'detail': 'Тема уже сыграна'}
 
 
@@ -183,6 +209,10 @@ class ResultSchema(Schema):
     position1: int = 0
     rating2: int = 0
     position2: int = 0
+    duel_rating1: int = 0
+    duel_position1: int = 0
+    duel_rating2: int = 0
+    duel_position2: int = 0
 
 
 @router.post('/finish', response={200: ResultSchema, 404: Message404})
@@ -195,7 +225,16 @@ def finish_round(request, data: FinishSchema):
         hits2=data.hits2,
         abort_side=data.abort_side
     )
-    return {'rating1': rating1, 'position1': position1, 'rating2': rating2, 'position2': position2}
+    result = {'rating1': rating1, 'position1': position1, 'rating2': rating2, 'position2': position2}
+    # Positions are only zero when the round had been finished already
+    if round.duel and position1:
+        result.update({
+            'duel_rating1': round.player1.duel_rating,
+            'duel_position1': round.player1.duel_position,
+            'duel_rating2': round.player2.duel_rating,
+            'duel_position2': round.player2.duel_position
+        })
+    return result
 
 
 class ObjectGroupModerationSchema(Schema):
@@ -237,12 +276,19 @@ class AttemptSchema(Schema):
 
 @router.post('/answer', response={200: AttemptSchema, 403: Message403, 404: Message404})
 def answer(request, data: AnswerSchema):
-    round = get_object_or_404(Round, id=data.round_id)
+    # One transaction per answer: the round row is locked and written once at the end
+    with transaction.atomic():
+        round = Round.lock(data.round_id)
+        response = submit_answer(round, data)
+        round.save_answer_changes()
+    return response
+
 
+def submit_answer(round: Round, data: AnswerSchema):
     skipped = data.answer == '-'
 
     if data.entity_id:
-        topic_entity = get_object_or_404(TopicEntity, id=data.entity_id)
+        topic_entity = get_object_or_404(TopicEntity.objects.select_related('entity'), id=data.entity_id)
         created = Answer.get_or_create(round=round, topic_entity=topic_entity, text=data.answer, player=data.side)
         if not created:
             round.add_declined_answer(data.answer, 'CHOICE REPEAT')
@@ -317,9 +363,53 @@ class AnswerModerationSchema(Schema):
     entity_pattern: str | None = None
 
 
+class MatchInSchema(Schema):
+    topic_id: int
+    text: str
+
+
+class MatchOutSchema(Schema):
+    topic_id: int
+    text: str
+    entities: list[TopicEntitySchema]
+
+
+class MatchBatchSchema(Schema):
+    items: list[MatchInSchema]
+
+
+@router.post('/match', response={200: list[MatchOutSchema], 400: Message400})
+def match_answers(request, data: MatchBatchSchema):
+    # Every distinct topic of the batch loads its whole index
+    if len(data.items) > Config.max_match_batch_size:
+        return 400, {'detail': f'Не больше {Config.max_match_batch_size} ответов за запрос'}
+    items = [(item.topic_id, item.text) for item in data.items]
+    return [
+        {'topic_id': topic_id, 'text': text, 'entities': topic_entities}
+        for (topic_id, text), topic_entities in zip(items, Topic.get_matching_entities_bulk(items))
+    ]
+
+
+class NegativeCacheStatsSchema(Schema):
+    hits: int
+    misses: int
+    hit_rate: float
+    evictions: int
+    invalidations: int
+    topics: int
+    texts: int
+
+
+# Counters of the worker that serves the request
+@router.get('/matcher-stats', response={200: NegativeCacheStatsSchema})
+def get_matcher_stats(request):
+    return get_negative_cache_stats()
+
+
 @router.put('/answer', response={200: Message200, 404: Message404})
 def put_answer(request, data: AnswerModerationSchema):
     answer = get_object_or_404(Answer, id=data.answer_id)
+    topic_entity = None
     if data.topic_entity_id:
         topic_entity = get_object_or_404(TopicEntity, id=data.topic_entity_id)
         answer.assign_topic_entity(topic_entity=topic_entity)
@@ -341,7 +431,8 @@ def put_answer(request, data: AnswerModerationSchema):
             entity.compile_pattern(data.entity_pattern)
         topic_entity = TopicEntity.objects.create(topic=answer.round.topic, entity=entity)
         answer.assign_topic_entity(topic_entity=topic_entity)
-    answer.round.topic.gather_matches()
+    if topic_entity:
+        topic_entity.topic.update_entity_matches(topic_entity.entity)
     return {'detail': 'ok'}
 
 
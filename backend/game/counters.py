@@ -0,0 +1,71 @@
+import threading
+from collections import Counter
+
+import redis
+from django.conf import settings
+
+
+class LocalCounterBuffer:
+    # In-process fallback for tests and development: nothing else sees these counts, so they are flushed
+    # after every answer and only kept here when a flush fails
+    shared = False
+
+    def __init__(self):
+        self.counts: Counter[int] = Counter()
+        self.lock = threading.Lock()
+
+    def add(self, object_id: int, increment: int = 1) -> None:
+        with self.lock:
+            self.counts[object_id] += increment
+
+    def add_many(self, counts: dict[int, int]) -> None:
+        with self.lock:
+            self.counts.update(counts)
+
+    def take(self) -> dict[int, int]:
+        with self.lock:
+            counts, self.counts = self.counts, Counter()
+        return dict(counts)
+
+
+class RedisCounterBuffer:
+    # Pending increments shared by all workers in one hash; whoever claims the flush first schedules it
+    shared = True
+
+    def __init__(self, url: str, key: str = 'answer-counts'):
+        self.redis = redis.Redis.from_url(url)
+        self.key = key
+
+    def add(self, object_id: int, increment: int = 1) -> None:
+        self.redis.hincrby(f'{self.key}:pending', object_id, increment)
+
+    def add_many(self, counts: dict[int, int]) -> None:
+        pipeline = self.redis.pipeline(transaction=True)
+        for object_id, increment in counts.items():
+            pipeline.hincrby(f'{self.key}:pending', object_id, increment)
+        pipeline.execute()
+
+    def take(self) -> dict[int, int]:
+        pipeline = self.redis.pipeline(transaction=True)
+        pipeline.hgetall(f'{self.key}:pending')
+        pipeline.delete(f'{self.key}:pending')
+        counts, _ = pipeline.execute()
+        return {int(object_id): int(count) for object_id, count in counts.items()}
+
+    def claim_flush(self, interval: float) -> bool:
+        return bool(self.redis.set(f'{self.key}:flush', 1, nx=True, px=int(interval * 1000)))
+
+
+_answer_counts: LocalCounterBuffer | RedisCounterBuffer | None = None
+
+
+def get_answer_counts() -> LocalCounterBuffer | RedisCounterBuffer:
+    global _answer_counts
+    if _answer_counts is None:
+        _answer_counts = RedisCounterBuffer(settings.REDIS_URL) if settings.REDIS_URL else LocalCounterBuffer()
+    return _answer_counts
+
+
+def clear_answer_counts() -> None:
+    global _answer_counts
+    _answer_counts = None
@@ -0,0 +1,73 @@
+import json
+import logging
+import traceback
+from typing import Callable
+
+from django.apps import apps
+from django.core.signals import request_finished
+from django.db import transaction
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 5
+RETRY_DELAY = 30
+
+_tasks: dict[str, Callable] = {}
+
+
+def task(function: Callable) -> Callable:
+    _tasks[function.__name__] = function
+    return function
+
+
+def enqueue(name: str, *args, key: str = '', delay: int = 0) -> None:
+    # The job is stored in the current transaction, so it exists exactly when the change that caused it does.
+    # A waiting job with the same key absorbs the new one; a running job is locked and skipped, so changes
+    # made while it runs still get their own job
+    Job = apps.get_model('game', 'Job')
+    with transaction.atomic():
+        if key and Job.objects.select_for_update(skip_locked=True).filter(key=key, failed=False).exists():
+            return
+        Job.objects.create(
+            name=name,
+            key=key,
+            args=json.dumps(args),
+            run_after=timezone.now() + timezone.timedelta(seconds=delay)
+        )
+
+
+def run_next() -> bool:
+    Job = apps.get_model('game', 'Job')
+    with transaction.atomic():
+        job = Job.objects.select_for_update(skip_locked=True).filter(
+            failed=False,
+            run_after__lte=timezone.now()
+        ).order_by('run_after', 'id').first()
+        if not job:
+            return False
+        # Deleted up front so that the task can enqueue a job with its own key
+        Job.objects.filter(id=job.id).delete()
+        try:
+            with transaction.atomic():
+                _tasks[job.name](*json.loads(job.args))
+        except Exception:
+            logger.exception('Job %s %s failed', job.name, job.args)
+            job.attempts += 1
+            job.error = traceback.format_exc()
+            job.failed = job.attempts >= MAX_ATTEMPTS
+            job.run_after = timezone.now() + timezone.timedelta(seconds=RETRY_DELAY * 2**job.attempts)
+            job.save()
+    return True
+
+
+def run_after_response(function: Callable[[], None]) -> None:
+    # In-process work the current request should not wait for: it runs once the response has been sent.
+    # Failures are logged, as the response is already gone
+    def receiver(**kwargs) -> None:
+        request_finished.disconnect(receiver)
+        try:
+            function()
+        except Exception:
+            logger.exception('%s failed after the response', function.__qualname__)
+    request_finished.connect(receiver, weak=False)
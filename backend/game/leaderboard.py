@@ -0,0 +1,118 @@
+import threading
+from bisect import bisect_left, insort
+
+import redis
+from django.apps import apps
+from django.conf import settings
+
+
+class LocalLeaderboard:
+    # In-process fallback for tests and development: entries sorted by (-rating, player id)
+    def __init__(self):
+        self.entries: list[tuple[int, int]] = []
+        self.ratings: dict[int, int] = {}
+        self.lock = threading.Lock()
+
+    def exists(self) -> bool:
+        return bool(self.ratings)
+
+    def set(self, player_id: int, rating: int) -> None:
+        with self.lock:
+            self._remove(player_id)
+            self.ratings[player_id] = rating
+            insort(self.entries, (-rating, player_id))
+
+    def set_many(self, ratings: dict[int, int]) -> None:
+        for player_id, rating in ratings.items():
+            self.set(player_id, rating)
+
+    def remove(self, player_id: int) -> None:
+        with self.lock:
+            self._remove(player_id)
+
+    def _remove(self, player_id: int) -> None:
+        if player_id not in self.ratings:
+            return
+        entry = (-self.ratings.pop(player_id), player_id)
+        del self.entries[bisect_left(self.entries, entry)]
+
+    def replace(self, ratings: dict[int, int]) -> None:
+        with self.lock:
+            self.ratings = dict(ratings)
+            self.entries = sorted((-rating, player_id) for player_id, rating in ratings.items())
+
+    def rank(self, rating: int) -> int:
+        return bisect_left(self.entries, (-rating, 0)) + 1
+
+    def top(self, count: int) -> list[int]:
+        return [player_id for _, player_id in self.entries[:count]]
+
+    def items(self) -> dict[int, int]:
+        return dict(self.ratings)
+
+
+class RedisLeaderboard:
+    # Sorted set of player ids scored by rating, shared by all workers
+    def __init__(self, url: str, key: str = 'leaderboard:rating'):
+        self.redis = redis.Redis.from_url(url)
+        self.key = key
+
+    def exists(self) -> bool:
+        return bool(self.redis.exists(self.key))
+
+    def set(self, player_id: int, rating: int) -> None:
+        self.redis.zadd(self.key, {player_id: rating})
+
+    def set_many(self, ratings: dict[int, int]) -> None:
+        if ratings:
+            self.redis.zadd(self.key, ratings)
+
+    def remove(self, player_id: int) -> None:
+        self.redis.zrem(self.key, player_id)
+
+    def replace(self, ratings: dict[int, int], chunk_size: int = 10000) -> None:
+        # Filled aside and renamed over the live key, so readers never see a partial leaderboard
+        new_key = f'{self.key}:new'
+        self.redis.delete(new_key)
+        items = list(ratings.items())
+        for i in range(0, len(items), chunk_size):
+            self.redis.zadd(new_key, dict(items[i:i + chunk_size]))
+        if items:
+            self.redis.rename(new_key, self.key)
+        else:
+            self.redis.delete(self.key)
+
+    def rank(self, rating: int) -> int:
+        return self.redis.zcount(self.key, f'({rating}', '+inf') + 1
+
+    def top(self, count: int) -> list[int]:
+        return [int(player_id) for player_id in self.redis.zrevrange(self.key, 0, count - 1)]
+
+    def items(self) -> dict[int, int]:
+        return {int(player_id): int(rating) for player_id, rating in self.redis.zscan_iter(self.key)}
+
+
+# Ranked fields of Player and the filter selecting the players ranked by them
+RANKINGS = {
+    'rating': {},
+    'duel_rating': {'duel_rounds_count__gt': 0},
+}
+
+_leaderboards: dict[str, LocalLeaderboard | RedisLeaderboard] = {}
+
+
+def get_leaderboard(field: str = 'rating') -> LocalLeaderboard | RedisLeaderboard:
+    if field not in _leaderboards:
+        Player = apps.get_model('game', 'Player')
+        if settings.REDIS_URL:
+            leaderboard = RedisLeaderboard(settings.REDIS_URL, f'leaderboard:{field}')
+        else:
+            leaderboard = LocalLeaderboard()
+        if not leaderboard.exists():
+            leaderboard.replace(dict(Player.objects.filter(**RANKINGS[field]).values_list('id', field)))
+        _leaderboards[field] = leaderboard
+    return _leaderboards[field]
+
+
+def clear_leaderboard() -> None:
+    _leaderboards.clear()
@@ -0,0 +1,49 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from game.matching import get_normalizer, simplify_text
+from game.models import Answer
+
+
+class Command(BaseCommand):
+    help = 'Compare simplify_text with the compiled normalizer on stored answers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=100000)
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        corpus = list(
+            Answer.objects.order_by('-id')
+            .values_list('text', 'round__topic__exclusions', 'round__topic__extra_allowed_symbols')[:options['limit']]
+        )
+        if not corpus:
+            raise CommandError('No answers to benchmark')
+        reference = [
+            (text, exclusions.split(), extra_allowed_symbols) for text, exclusions, extra_allowed_symbols in corpus
+        ]
+        compiled = [
+            (text, get_normalizer(exclusions, extra_allowed_symbols))
+            for text, exclusions, extra_allowed_symbols in corpus
+        ]
+        for (text, odd_words, extra_allowed_symbols), (_, normalizer) in zip(reference, compiled):
+            expected = simplify_text(text, odd_words=odd_words, extra_allowed_symbols=extra_allowed_symbols)
+            if normalizer.simplify(text) != expected:
+                raise CommandError(f'Mismatch for {text!r}: {normalizer.simplify(text)!r} != {expected!r}')
+
+        reference_time, compiled_time = float('inf'), float('inf')
+        for _ in range(options['repeat']):
+            start = time.perf_counter()
+            for text, odd_words, extra_allowed_symbols in reference:
+                simplify_text(text, odd_words=odd_words, extra_allowed_symbols=extra_allowed_symbols)
+            reference_time = min(reference_time, time.perf_counter() - start)
+            start = time.perf_counter()
+            for text, normalizer in compiled:
+                normalizer.simplify(text)
+            compiled_time = min(compiled_time, time.perf_counter() - start)
+
+        count = len(corpus)
+        self.stdout.write(f'Answers: {count}, outputs identical')
+        self.stdout.write(f'simplify_text: {reference_time / count * 1e6:.2f} µs per answer')
+        self.stdout.write(f'Normalizer: {compiled_time / count * 1e6:.2f} µs per answer')
+        self.stdout.write(f'Speedup: {reference_time / compiled_time:.1f}x')
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from game.models import Topic
+
+from tqdm import tqdm
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the match dictionaries of topics from their entities'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--topic', type=int, help='Only this topic id')
+
+    def handle(self, *args, **options):
+        topics = Topic.objects.all()
+        if options['topic']:
+            topics = topics.filter(id=options['topic'])
+        for topic in tqdm(topics):
+            topic.gather_matches()
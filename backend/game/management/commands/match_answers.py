@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+from game.models import Answer, Topic
+
+from tqdm import tqdm
+
+
+class Command(BaseCommand):
+    help = 'Match unbound answers against the current topic patterns'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--topic', type=int, help='Only answers of this topic id')
+        parser.add_argument('--chunk-size', type=int, default=1000)
+        parser.add_argument('--apply', action='store_true', help='Bind answers that match exactly one entity')
+
+    def handle(self, *args, **options):
+        answers = Answer.objects.unbound().select_related('round').order_by('id')
+        if options['topic']:
+            answers = answers.filter(round__topic_id=options['topic'])
+        chunk_size = options['chunk_size']
+        matched, ambiguous, bound = 0, 0, 0
+        last_id = 0
+        with tqdm(total=answers.count()) as progress:
+            while chunk := list(answers.filter(id__gt=last_id)[:chunk_size]):
+                last_id = chunk[-1].id
+                items = [(answer.round.topic_id, answer.text) for answer in chunk]
+                bindings = []
+                for answer, topic_entities in zip(chunk, Topic.get_matching_entities_bulk(items)):
+                    if len(topic_entities) == 1:
+                        matched += 1
+                        bindings.append((answer, topic_entities[0]))
+                        if not options['apply']:
+                            self.stdout.write(f'{answer.id}\t{answer.text}\t{topic_entities[0]}')
+                    elif topic_entities:
+                        ambiguous += 1
+                if options['apply'] and bindings:
+                    bound += Answer.bind(bindings)
+                progress.update(len(chunk))
+        self.stdout.write(f'Matched: {matched}, ambiguous: {ambiguous}, bound: {bound}')
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from game.leaderboard import RANKINGS, get_leaderboard
+from game.models import Player
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the rating leaderboard from the database or check it against the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true', help='Only report players whose entry differs')
+        parser.add_argument('--field', choices=RANKINGS, default='rating', help='Ranked field')
+
+    def handle(self, *args, **options):
+        field = options['field']
+        leaderboard = get_leaderboard(field)
+        ratings = dict(Player.objects.filter(**RANKINGS[field]).values_list('id', field))
+        if not options['check']:
+            leaderboard.replace(ratings)
+            self.stdout.write(f'Players in leaderboard: {len(ratings)}')
+            return
+        entries = leaderboard.items()
+        wrong = {player_id for player_id, rating in ratings.items() if entries.get(player_id) != rating}
+        extra = entries.keys() - ratings.keys()
+        for player_id in sorted(wrong):
+            self.stdout.write(f'Player {player_id}: {entries.get(player_id)} instead of {ratings[player_id]}')
+        for player_id in sorted(extra):
+            self.stdout.write(f'Player {player_id} is deleted but ranked with {entries[player_id]}')
+        self.stdout.write(f'Inconsistent entries: {len(wrong) + len(extra)}')
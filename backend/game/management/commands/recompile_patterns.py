@@ -0,0 +1,58 @@
+import datetime
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+from django.core.management.base import BaseCommand
+from game.matching import expand_pattern
+from game.models import Config, Entity, Topic, TopicEntity
+
+from tqdm import tqdm
+
+
+class Command(BaseCommand):
+    help = 'Recompile entity patterns in parallel and regather the topics whose matches changed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--topic', type=int, help='Only entities of this topic id')
+        parser.add_argument('--since', type=datetime.date.fromisoformat, help='Only entities changed since YYYY-MM-DD')
+        parser.add_argument('--chunk-size', type=int, default=1000)
+        parser.add_argument('--workers', type=int, default=None, help='Processes, all CPUs by default')
+
+    def handle(self, *args, **options):
+        entities = Entity.objects.order_by('id')
+        if options['topic']:
+            entities = entities.filter(topics__id=options['topic'])
+        if options['since']:
+            entities = entities.filter(updated_at__date__gte=options['since'])
+        rows = list(entities.values_list('id', 'pattern', 'matches'))
+        chunk_size = options['chunk_size']
+        workers = options['workers'] or os.cpu_count()
+
+        changed_count = 0
+        topic_ids = set()
+        with ProcessPoolExecutor(max_workers=workers) as executor, tqdm(total=len(rows)) as progress:
+            for start in range(0, len(rows), chunk_size):
+                chunk = rows[start:start + chunk_size]
+                results = executor.map(
+                    expand_pattern,
+                    [pattern for _, pattern, _ in chunk],
+                    repeat(Config.max_pattern_spellings),
+                    chunksize=max(1, len(chunk) // (4 * workers))
+                )
+                changed = [
+                    Entity(id=entity_id, matches=matches)
+                    for (entity_id, _, old_matches), matches in zip(chunk, results) if matches != old_matches
+                ]
+                if changed:
+                    Entity.objects.bulk_update(changed, ['matches'])
+                    topic_ids.update(
+                        TopicEntity.objects.filter(entity_id__in=[entity.id for entity in changed])
+                        .values_list('topic_id', flat=True)
+                    )
+                changed_count += len(changed)
+                progress.update(len(chunk))
+
+        self.stdout.write(f'Entities: {len(rows)}, changed: {changed_count}, topics to regather: {len(topic_ids)}')
+        for topic in tqdm(Topic.objects.filter(id__in=topic_ids)):
+            topic.gather_matches()
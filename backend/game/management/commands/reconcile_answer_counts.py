@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from game.models import Topic, TopicEntity
+
+from tqdm import tqdm
+
+
+class Command(BaseCommand):
+    help = 'Flush buffered answer counts and rebuild the counters of topic entities from the answers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--topic', type=int, help='Only this topic id')
+
+    def handle(self, *args, **options):
+        TopicEntity.flush_answer_counts()
+        topics = Topic.objects.all()
+        if options['topic']:
+            topics = topics.filter(id=options['topic'])
+        drifted = 0
+        for topic in tqdm(topics):
+            drifted += topic.reconcile_answers_counts()
+        self.stdout.write(f'Topic entities corrected: {drifted}')
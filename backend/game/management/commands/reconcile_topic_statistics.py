@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from game.models import Topic
+
+from tqdm import tqdm
+
+
+class Command(BaseCommand):
+    help = 'Recompute the running score sums and averages of topics from their rounds'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--topic', type=int, help='Only this topic id')
+
+    def handle(self, *args, **options):
+        topics = Topic.objects.all()
+        if options['topic']:
+            topics = topics.filter(id=options['topic'])
+        fields = ['score_sum', 'rounds_count', 'score_sum_hits_mode', 'rounds_count_hits_mode']
+        drifted = 0
+        for topic in tqdm(topics):
+            running = [getattr(topic, field) for field in fields]
+            topic.update_statistics()
+            if running != [getattr(topic, field) for field in fields]:
+                drifted += 1
+        self.stdout.write(f'Topics corrected: {drifted}')
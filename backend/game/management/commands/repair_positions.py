@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from game.models import Topic, TopicEntity
+
+from tqdm import tqdm
+
+
+class Command(BaseCommand):
+    help = 'Re-sort the entity positions of topics by their answer counts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--topic', type=int, help='Only this topic id')
+
+    def handle(self, *args, **options):
+        topics = Topic.objects.all()
+        if options['topic']:
+            topics = topics.filter(id=options['topic'])
+        repaired = 0
+        for topic in tqdm(topics):
+            positions = list(TopicEntity.objects.filter(topic=topic).values_list('id', 'position'))
+            topic.update_entities_positions()
+            if sorted(positions) != sorted(TopicEntity.objects.filter(topic=topic).values_list('id', 'position')):
+                repaired += 1
+        self.stdout.write(f'Topics repaired: {repaired}')
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from game.models import Player
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the Elo duel ratings of all players from the finished duels in chronological order'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=5000, help='Rows per fetch and per update')
+
+    def handle(self, *args, **options):
+        updated_count = Player.replay_duel_ratings(options['chunk_size'])
+        self.stdout.write(f'Players updated: {updated_count}')
@@ -0,0 +1,21 @@
+import time
+
+from django.core.management.base import BaseCommand
+from game import tasks  # noqa: F401 registers the tasks
+from game.jobs import run_next
+
+
+class Command(BaseCommand):
+    help = 'Run queued background jobs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Exit when no job is due instead of polling')
+        parser.add_argument('--poll', type=float, default=1, help='Seconds to wait when the queue is empty')
+
+    def handle(self, *args, **options):
+        while True:
+            if run_next():
+                continue
+            if options['once']:
+                break
+            time.sleep(options['poll'])
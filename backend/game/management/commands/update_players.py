@@ -5,10 +5,16 @@ from tqdm import tqdm
 
 
 class Command(BaseCommand):
+    help = 'Refresh the aged ratings and levels of all players'
 
     def add_arguments(self, parser):
-        pass
+        parser.add_argument('--full', action='store_true', help='Recount every statistic of each player one by one')
+        parser.add_argument('--chunk-size', type=int, default=5000, help='Players per locked chunk')
 
     def handle(self, *args, **options):
-        for player in tqdm(Player.objects.all()):
-            player.update_statistics()
+        if options['full']:
+            for player in tqdm(Player.objects.all()):
+                player.update_statistics(full=True)
+            return
+        updated_count = Player.update_ratings(options['chunk_size'])
+        self.stdout.write(f'Players updated: {updated_count}')
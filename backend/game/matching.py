@@ -0,0 +1,448 @@
+import itertools
+import re
+from collections import Counter, OrderedDict, defaultdict
+from functools import lru_cache
+from typing import Iterable
+
+import jellyfish
+
+
+def remove_successive_letters(s: str) -> str:
+    result = []
+    for char, group in itertools.groupby(s):
+        if char.isdigit() or char in 'ix+':
+            result.extend(list(group))
+        else:
+            result.append(char)
+    return ''.join(result)
+
+
+def simplify_text(text: str, odd_words: list[str] = [], extra_allowed_symbols: str = '') -> str:
+    text = text.lower().replace('э', 'е').replace('ё', 'е').replace('й', 'и')
+    text = ''.join(char for char in text if char.isalnum() or char in extra_allowed_symbols)
+    text = remove_successive_letters(text)
+    for word in odd_words:
+        text = text.replace(word, '')
+    return text
+
+
+class TranslationTable(dict):
+    # Filled lazily: str.translate asks only for characters that actually occur
+    def __init__(self, extra_allowed_symbols: str):
+        super().__init__({ord('э'): 'е', ord('ё'): 'е', ord('й'): 'и'})
+        self.extra_allowed_symbols = extra_allowed_symbols
+
+    def __missing__(self, key: int) -> int | None:
+        char = chr(key)
+        value = key if char.isalnum() or char in self.extra_allowed_symbols else None
+        self[key] = value
+        return value
+
+
+SUCCESSIVE_LETTERS_RE = re.compile(r'(.)\1+', re.DOTALL)
+
+
+def collapse_successive_letters(match: re.Match) -> str:
+    char = match.group(1)
+    if char.isdigit() or char in 'ix+':
+        return match.group(0)
+    return char
+
+
+class Normalizer:
+    # Compiled equivalent of simplify_text for one set of odd words and allowed symbols
+    def __init__(self, odd_words: tuple[str, ...] = (), extra_allowed_symbols: str = ''):
+        self.odd_words = odd_words
+        self.table = TranslationTable(extra_allowed_symbols)
+        self.odd_words_re = re.compile('|'.join(map(re.escape, odd_words))) if odd_words else None
+
+    def remove_odd_words(self, text: str) -> str:
+        # Words are still removed one after another, as a single alternation would give different results
+        # when removing one word produces another; the regex only skips texts without any of them
+        if self.odd_words_re is None or not self.odd_words_re.search(text):
+            return text
+        for word in self.odd_words:
+            text = text.replace(word, '')
+        return text
+
+    def simplify(self, text: str) -> str:
+        text = text.lower().translate(self.table)
+        text = SUCCESSIVE_LETTERS_RE.sub(collapse_successive_letters, text)
+        return self.remove_odd_words(text)
+
+
+@lru_cache(maxsize=None)
+def get_normalizer(exclusions: str, extra_allowed_symbols: str) -> Normalizer:
+    return Normalizer(tuple(exclusions.split()), extra_allowed_symbols)
+
+
+MALE_ORDINALS = [
+    'нулевой', 'первыи', 'второи', 'трети', 'четвертыи', 'пятыи', 'шестои', 'седьмои', 'восьмои', 'девятыи',
+    'десятыи', 'одинадцатыи', 'двенадцатыи', 'тринадцатыи', 'четырнадцатыи', 'пятнадцатыи', 'шестнадцатыи',
+    'семнадцатыи', 'восемнадцатыи', 'девятнадцатыи', 'двадцатыи', 'двадцатьпервыи', 'двадцатьвторои',
+    'двадцатьтрети', 'двадцатьчетвертыи', 'двадцатьпятыи', 'двадцатьшестои', 'двадцатьседьмои',
+    'двадцатьвосьмои', 'двадцатьдевятыи', 'тридцатыи'
+]
+FEMALE_ORDINALS = [
+    'нулевая', 'первая', 'вторая', 'третья', 'четвертая', 'пятая', 'шестая', 'седьмая', 'восьмая',
+    'девятая', 'десятая', 'одинадцатая', 'двенадцатая', 'тринадцатая', 'четырнадцатая', 'пятнадцатая',
+    'шестнадцатая', 'семнадцатая', 'восемнадцатая', 'девятнадцатая', 'двадцатая', 'двадцатьпервая',
+    'двадцатьвторая', 'двадцатьтретья', 'двадцатьчетвертая', 'двадцатьпятая', 'двадцатьшестая',
+    'двадцатьседьмая', 'двадцатьвосьмая', 'двадцатьдевятая', 'тридцатая'
+]
+ROMAN_NUMBERS = [
+    '', 'i', 'ii', 'iii', 'iv', 'v', 'vi', 'vii', 'viii', 'ix', 'x', 'xi', 'xii', 'xiii', 'xiv', 'xv',
+    'xvi', 'xvii', 'xviii', 'xix', 'xx', 'xxi', 'xxii', 'xxiii', 'xxiv', 'xxv', 'xxvi', 'xxvii', 'xxvii',
+    'xxix', 'xxx'
+]
+
+
+def parse_bracket_group(item: str) -> list[str]:
+    if len(item) == 1:
+        return [item, '']
+    elif '|' in item:
+        return item.split('|')
+    return list(item)
+
+
+def parse_ordinal(item: str) -> list[str]:
+    num = int(item[:-1])
+    if num > 30:
+        return [item]
+    male: bool = item[-1] == 'и'
+    return [
+        str(num),
+        ROMAN_NUMBERS[num],
+        MALE_ORDINALS[num] if male else FEMALE_ORDINALS[num]
+    ]
+
+
+def is_bracket_group(item: str) -> bool:
+    return item.startswith('(') and item.endswith(')') and ')' not in item[1:-1]
+
+
+class PatternAutomaton:
+    # Entity pattern compiled to a letter-level NFA: its size follows the pattern, not the number of spellings.
+    # Grammar: items are concatenated, '(abc)' is one of the letters, '(a)' is an optional letter, '(ab|cd)' or
+    # '(ab cd)' are alternatives, '*item' is an optional item, '1я'/'1и' are ordinals, ' / ' separates variants
+    # and 'a b c = 13 23' lists item combinations that are obligatory
+    START = 0
+    FINAL = 1
+
+    def __init__(self, pattern: str):
+        self.transitions: list[list[tuple[str, int]]] = [[], []]
+        pattern = re.sub(r'\(([^)]*)\)', lambda match: f'({match.group(1).replace(" ", "|")})', pattern)
+        if ' = ' in pattern:
+            pattern, obligatory_combinations = pattern.split(' = ')
+            alternatives = []
+            for combination in obligatory_combinations.split():
+                combination = [int(num) - 1 for num in combination]
+                alternatives.append(
+                    ' '.join(item if n in combination else f'*{item}' for n, item in enumerate(pattern.split()))
+                )
+        else:
+            alternatives = pattern.split(' / ')
+        for alternative in alternatives:
+            state = self.START
+            for item in alternative.split():
+                state = self.add_item(state, item)
+            self.add_edge(state, '', self.FINAL)
+        self.order = self.get_topological_order()
+
+    def add_state(self) -> int:
+        self.transitions.append([])
+        return len(self.transitions) - 1
+
+    def add_edge(self, state: int, label: str, target: int) -> None:
+        for char in label[:-1]:
+            next_state = self.add_state()
+            self.transitions[state].append((char, next_state))
+            state = next_state
+        self.transitions[state].append((label[-1:], target))
+
+    def add_choice(self, state: int, options: list[str]) -> int:
+        target = self.add_state()
+        for option in options:
+            self.add_edge(state, option, target)
+        return target
+
+    def add_item(self, state: int, item: str) -> int:
+        if is_bracket_group(item):
+            return self.add_choice(state, parse_bracket_group(item[1:-1]))
+        if item.startswith('*(') and is_bracket_group(item[1:]):
+            return self.add_choice(state, parse_bracket_group(item[2:-1]) + [''])
+        optional = item.startswith('*')
+        if optional:
+            item = item[1:]
+        if re.match(r'^\d+[ия]$', item):
+            target = self.add_choice(state, parse_ordinal(item))
+        else:
+            target = state
+            for subitem in item.replace('(', ' (').replace(')', ') ').split():
+                if is_bracket_group(subitem):
+                    target = self.add_choice(target, parse_bracket_group(subitem[1:-1]))
+                else:
+                    target = self.add_choice(target, [subitem])
+        if optional and target != state:
+            self.add_edge(state, '', target)
+        return target
+
+    def get_topological_order(self) -> list[int]:
+        incoming = [0] * len(self.transitions)
+        for transitions in self.transitions:
+            for _, target in transitions:
+                incoming[target] += 1
+        order = [state for state, count in enumerate(incoming) if not count]
+        for state in order:
+            for _, target in self.transitions[state]:
+                incoming[target] -= 1
+                if not incoming[target]:
+                    order.append(target)
+        return order
+
+    def count_spellings(self) -> int:
+        counts = [0] * len(self.transitions)
+        counts[self.FINAL] = 1
+        for state in reversed(self.order):
+            for _, target in self.transitions[state]:
+                counts[state] += counts[target]
+        return counts[self.START]
+
+    def get_spellings(self) -> list[str]:
+        # Same set of spellings the pattern expanded to before automata, in the same form
+        suffixes: list[list[str]] = [[] for _ in self.transitions]
+        suffixes[self.FINAL] = ['']
+        for state in reversed(self.order):
+            for char, target in self.transitions[state]:
+                suffixes[state].extend(char + suffix for suffix in suffixes[target])
+        spellings = [remove_successive_letters(item) for item in set(suffixes[self.START]) if item]
+        return sorted(spellings)
+
+    def match(self, text: str, odd_words: tuple[str, ...] = (), max_edits: int = 1) -> bool:
+        # Walks the automaton and the text together. A configuration also keeps the previous letter (repeated
+        # letters collapse as in remove_successive_letters), the odd words being skipped and whether
+        # a transposition of two letters is in progress. Odd words are removed one after another, so a word
+        # may be skipped inside another one that comes later in the list. They may be skipped at any
+        # occurrence, so every text close to a spelling with the odd words removed matches, and a few more
+        length = len(text)
+        start = (self.START, '', 0, 0, (), False, False)
+        stack = [start]
+        seen = {start}
+        while stack:
+            state, previous, position, edits, skip, swap, nonempty = stack.pop()
+            if state == self.FINAL and position == length and not skip and not swap and nonempty:
+                return True
+            following = []
+            if edits < max_edits and position < length and not skip and not swap:
+                following.append((state, previous, position + 1, edits + 1, skip, swap, nonempty))
+            for char, target in self.transitions[state]:
+                if not char:
+                    following.append((target, previous, position, edits, skip, swap, nonempty))
+                    continue
+                if char == previous and not (char.isdigit() or char in 'ix+'):
+                    following.append((target, char, position, edits, skip, swap, True))
+                    continue
+                word_index = len(odd_words)
+                if skip:
+                    # skip holds (index, rest of the word) pairs, the innermost word last
+                    word_index, rest = skip[-1]
+                    if rest[0] == char:
+                        rest_skip = skip[:-1] + ((word_index, rest[1:]),) if rest[1:] else skip[:-1]
+                        following.append((target, char, position, edits, rest_skip, swap, True))
+                elif swap:
+                    if text[position] == char:
+                        following.append((target, char, position + 2, edits, skip, False, True))
+                else:
+                    if position < length and text[position] == char:
+                        following.append((target, char, position + 1, edits, skip, swap, True))
+                    if edits < max_edits:
+                        following.append((target, char, position, edits + 1, skip, swap, True))
+                        if position < length:
+                            following.append((target, char, position + 1, edits + 1, skip, swap, True))
+                        if position + 1 < length and text[position + 1] == char != text[position]:
+                            following.append((target, char, position, edits + 1, skip, True, True))
+                # An odd word may also lie between the two letters of a transposition
+                for i, word in enumerate(odd_words[:word_index]):
+                    if word[0] == char:
+                        word_skip = skip + ((i, word[1:]),) if word[1:] else skip
+                        following.append((target, char, position, edits, word_skip, swap, True))
+            for configuration in following:
+                if configuration not in seen:
+                    seen.add(configuration)
+                    stack.append(configuration)
+        return False
+
+
+@lru_cache(maxsize=1024)
+def get_automaton(pattern: str) -> PatternAutomaton:
+    return PatternAutomaton(pattern)
+
+
+def expand_pattern(pattern: str, max_spellings: int) -> str:
+    # Patterns with too many spellings are not expanded and are matched by the automaton directly
+    automaton = PatternAutomaton(pattern)
+    if automaton.count_spellings() > max_spellings:
+        return ''
+    return ' '.join(automaton.get_spellings())
+
+
+def get_deletes(s: str) -> set[str]:
+    return {s[:i] + s[i + 1:] for i in range(len(s))}
+
+
+class TopicIndex:
+    def __init__(
+            self,
+            stamp: tuple,
+            matches: dict[str, list[int]],
+            normalizer: Normalizer,
+            patterns: dict[int, str] | None = None
+    ):
+        self.stamp = stamp
+        self.matches = matches
+        self.normalizer = normalizer
+        # Entities whose patterns are too large to expand are matched by their automata
+        self.automata = {entity_id: get_automaton(pattern) for entity_id, pattern in (patterns or {}).items()}
+        # Deletion neighbourhood: every key with one letter removed -> keys it was made of
+        self.deletes = defaultdict(list)
+        for match in matches:
+            self.add_deletes(match)
+
+    def add_deletes(self, match: str) -> None:
+        for delete in get_deletes(match):
+            self.deletes[delete].append(match)
+
+    def update(
+            self,
+            removed: Iterable[tuple[str, int, bool]],
+            added: Iterable[tuple[str, int, bool]],
+            stamp: tuple
+    ) -> None:
+        for key, entity_id, automaton in removed:
+            if automaton:
+                del self.automata[entity_id]
+                continue
+            self.matches[key].remove(entity_id)
+            if not self.matches[key]:
+                del self.matches[key]
+                for delete in get_deletes(key):
+                    self.deletes[delete].remove(key)
+        for key, entity_id, automaton in added:
+            if automaton:
+                self.automata[entity_id] = get_automaton(key)
+                continue
+            if key not in self.matches:
+                self.matches[key] = []
+                self.add_deletes(key)
+            self.matches[key].append(entity_id)
+        self.stamp = stamp
+
+    def lookup(self, text: str) -> list[int]:
+        text = self.normalizer.simplify(text)
+        return self.lookup_exact(text) or self.lookup_similar(text)
+
+    def lookup_exact(self, text: str) -> list[int]:
+        return self.matches.get(text, []) + self.lookup_automata(text, max_edits=0)
+
+    def lookup_automata(self, text: str, max_edits: int = 1) -> list[int]:
+        return [
+            entity_id for entity_id, automaton in self.automata.items()
+            if automaton.match(text, self.normalizer.odd_words, max_edits)
+        ]
+
+    def lookup_similar(self, text: str) -> list[int]:
+        # Any key within distance 1 shares the text itself or one of its deletes, so only these are verified
+        candidates = set(self.deletes.get(text, []))
+        if text in self.matches:
+            candidates.add(text)
+        for delete in get_deletes(text):
+            if delete in self.matches:
+                candidates.add(delete)
+            candidates.update(self.deletes.get(delete, []))
+        matching_ids = []
+        for match in candidates:
+            if jellyfish.damerau_levenshtein_distance(match, text) <= 1:
+                matching_ids += self.matches[match]
+        return matching_ids + self.lookup_automata(text)
+
+
+# Long-lived per-worker cache: topic id -> index, rebuilt when the topic's stamp changes
+_topic_indexes: dict[int, TopicIndex] = {}
+
+
+def get_topic_stamp(topic) -> tuple:
+    return topic.matches_version, topic.exclusions, topic.extra_allowed_symbols
+
+
+def get_topic_index(topic, build: bool = True) -> TopicIndex | None:
+    stamp = get_topic_stamp(topic)
+    index = _topic_indexes.get(topic.id)
+    if index is not None and index.stamp == stamp:
+        return index
+    if not build:
+        return None
+    matches = defaultdict(list)
+    patterns = {}
+    for key, entity_id, automaton in topic.topic_matches.values_list('key', 'entity_id', 'automaton'):
+        if automaton:
+            patterns[entity_id] = key
+        else:
+            matches[key].append(entity_id)
+    index = TopicIndex(stamp, dict(matches), topic.get_normalizer(), patterns)
+    _topic_indexes[topic.id] = index
+    return index
+
+
+def clear_topic_indexes() -> None:
+    _topic_indexes.clear()
+    _negative_caches.clear()
+
+
+class NegativeCache:
+    # Bounded LRU of simplified texts known to match nothing in one state of the topic's matches
+    def __init__(self, stamp: tuple, size: int):
+        self.stamp = stamp
+        self.size = size
+        self.texts: OrderedDict[str, None] = OrderedDict()
+
+    def __contains__(self, text: str) -> bool:
+        if text in self.texts:
+            self.texts.move_to_end(text)
+            negative_cache_stats['hits'] += 1
+            return True
+        negative_cache_stats['misses'] += 1
+        return False
+
+    def add(self, text: str) -> None:
+        self.texts[text] = None
+        if len(self.texts) > self.size:
+            self.texts.popitem(last=False)
+            negative_cache_stats['evictions'] += 1
+
+
+_negative_caches: dict[int, NegativeCache] = {}
+negative_cache_stats = Counter()
+
+
+def get_negative_cache(topic, size: int) -> NegativeCache:
+    stamp = get_topic_stamp(topic)
+    negative_cache = _negative_caches.get(topic.id)
+    if negative_cache is None or negative_cache.stamp != stamp:
+        if negative_cache is not None:
+            negative_cache_stats['invalidations'] += 1
+        negative_cache = NegativeCache(stamp, size)
+        _negative_caches[topic.id] = negative_cache
+    return negative_cache
+
+
+def get_negative_cache_stats() -> dict[str, int | float]:
+    lookups = negative_cache_stats['hits'] + negative_cache_stats['misses']
+    return {
+        'hits': negative_cache_stats['hits'],
+        'misses': negative_cache_stats['misses'],
+        'hit_rate': round(negative_cache_stats['hits'] / lookups, 4) if lookups else 0,
+        'evictions': negative_cache_stats['evictions'],
+        'invalidations': negative_cache_stats['invalidations'],
+        'topics': len(_negative_caches),
+        'texts': sum(len(negative_cache.texts) for negative_cache in _negative_caches.values()),
+    }
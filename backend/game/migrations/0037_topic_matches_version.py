@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-18 05:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0036_round_attempt'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='topic',
+            name='matches_version',
+            field=models.PositiveIntegerField(default=0, verbose_name='Версия словаря совпадений'),
+        ),
+    ]
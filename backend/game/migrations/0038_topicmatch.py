@@ -0,0 +1,61 @@
+# Generated by Django 4.2 on 2026-10-18 05:34
+
+import json
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def copy_matches(apps, schema_editor):
+    Entity = apps.get_model('game', 'Entity')
+    Topic = apps.get_model('game', 'Topic')
+    TopicMatch = apps.get_model('game', 'TopicMatch')
+    entity_ids = set(Entity.objects.values_list('id', flat=True))
+    for topic in Topic.objects.all():
+        TopicMatch.objects.bulk_create(
+            [
+                TopicMatch(topic=topic, key=key, entity_id=entity_id)
+                for key, ids in json.loads(topic.matches).items()
+                for entity_id in set(ids) if entity_id in entity_ids
+            ],
+            batch_size=1000
+        )
+
+
+def copy_matches_back(apps, schema_editor):
+    Topic = apps.get_model('game', 'Topic')
+    TopicMatch = apps.get_model('game', 'TopicMatch')
+    for topic in Topic.objects.all():
+        matches = {}
+        for key, entity_id in TopicMatch.objects.filter(topic=topic).values_list('key', 'entity_id'):
+            matches.setdefault(key, []).append(entity_id)
+        topic.matches = json.dumps(matches, ensure_ascii=False)
+        topic.save()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0037_topic_matches_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TopicMatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.TextField(verbose_name='Ключ')),
+                ('entity', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='topic_matches', to='game.entity', verbose_name='Сущность')),
+                ('topic', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='topic_matches', to='game.topic', verbose_name='Тема')),
+            ],
+            options={
+                'verbose_name_plural': 'topic matches',
+                'unique_together': {('topic', 'key', 'entity')},
+            },
+        ),
+        migrations.RunPython(copy_matches, copy_matches_back),
+        migrations.RemoveField(
+            model_name='topic',
+            name='matches',
+        ),
+    ]
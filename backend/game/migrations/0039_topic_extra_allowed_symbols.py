@@ -0,0 +1,24 @@
+# Generated by Django 4.2 on 2026-10-18 05:35
+
+from django.db import migrations, models
+
+
+def set_programming_languages_symbols(apps, schema_editor):
+    Topic = apps.get_model('game', 'Topic')
+    Topic.objects.filter(title='Языки программирования').update(extra_allowed_symbols='+#')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0038_topicmatch'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='topic',
+            name='extra_allowed_symbols',
+            field=models.CharField(blank=True, max_length=20, verbose_name='Дополнительные допустимые символы'),
+        ),
+        migrations.RunPython(set_programming_languages_symbols, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-18 05:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0039_topic_extra_allowed_symbols'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='topicmatch',
+            name='automaton',
+            field=models.BooleanField(default=False, verbose_name='Ключ — паттерн для автомата'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-18 05:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0040_topicmatch_automaton'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='entity',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, null=True, verbose_name='Изменена'),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 4.2 on 2026-10-18 05:45
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def fill_score_sums(apps, schema_editor):
+    Topic = apps.get_model('game', 'Topic')
+    for topic in Topic.objects.all():
+        for suffix, hits_mode in (('', False), ('_hits_mode', True)):
+            aggregate = topic.rounds.filter(finished_at__isnull=False, hits_mode=hits_mode).aggregate(
+                score_sum=Sum('score1'),
+                rounds_count=Count('id')
+            )
+            setattr(topic, f'score_sum{suffix}', aggregate['score_sum'] or 0)
+            setattr(topic, f'rounds_count{suffix}', aggregate['rounds_count'])
+        topic.save(update_fields=['score_sum', 'rounds_count', 'score_sum_hits_mode', 'rounds_count_hits_mode'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0042_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='topic',
+            name='rounds_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='Число завершённых раундов'),
+        ),
+        migrations.AddField(
+            model_name='topic',
+            name='rounds_count_hits_mode',
+            field=models.PositiveIntegerField(default=0, verbose_name='Число завершённых раундов в хитах'),
+        ),
+        migrations.AddField(
+            model_name='topic',
+            name='score_sum',
+            field=models.PositiveIntegerField(default=0, verbose_name='Сумма результатов'),
+        ),
+        migrations.AddField(
+            model_name='topic',
+            name='score_sum_hits_mode',
+            field=models.PositiveIntegerField(default=0, verbose_name='Сумма результатов в хитах'),
+        ),
+        migrations.RunPython(fill_score_sums, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 4.2 on 2026-10-18 05:47
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def fill_score_sums(apps, schema_editor):
+    Player = apps.get_model('game', 'Player')
+    for player in Player.objects.all():
+        chatgpt = player.rounds.filter(finished_at__isnull=False, duel=False).aggregate(s=Sum('score1'), c=Count('id'))
+        duel1 = player.rounds.filter(finished_at__isnull=False, duel=True).aggregate(s=Sum('score1'), c=Count('id'))
+        duel2 = player.guest_rounds.filter(finished_at__isnull=False, duel=True).aggregate(
+            s=Sum('score2'),
+            c=Count('id')
+        )
+        player.score_sum = chatgpt['s'] or 0
+        player.rounds_count = chatgpt['c']
+        player.duel_score_sum = (duel1['s'] or 0) + (duel2['s'] or 0)
+        player.duel_rounds_count = duel1['c'] + duel2['c']
+        player.save(update_fields=['score_sum', 'rounds_count', 'duel_score_sum', 'duel_rounds_count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0043_topic_score_sums'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='player',
+            name='duel_rounds_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='Число завершённых дуэлей'),
+        ),
+        migrations.AddField(
+            model_name='player',
+            name='duel_score_sum',
+            field=models.PositiveIntegerField(default=0, verbose_name='Сумма очков в дуэлях'),
+        ),
+        migrations.AddField(
+            model_name='player',
+            name='rounds_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='Число завершённых раундов'),
+        ),
+        migrations.AddField(
+            model_name='player',
+            name='score_sum',
+            field=models.PositiveIntegerField(default=0, verbose_name='Сумма очков'),
+        ),
+        migrations.RunPython(fill_score_sums, migrations.RunPython.noop),
+    ]
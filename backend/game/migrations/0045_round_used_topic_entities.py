@@ -0,0 +1,41 @@
+# Generated by Django 4.2 on 2026-10-18 07:10
+
+from collections import defaultdict
+
+from django.db import migrations, models
+
+
+def fill_used_topic_entities(apps, schema_editor):
+    Answer = apps.get_model('game', 'Answer')
+    Round = apps.get_model('game', 'Round')
+    used = defaultdict(list)
+    answers = Answer.objects.filter(topic_entity__isnull=False).order_by('id')
+    answers = answers.values_list('round_id', 'topic_entity_id')
+    for round_id, topic_entity_id in answers.iterator(chunk_size=10000):
+        if topic_entity_id not in used[round_id]:
+            used[round_id].append(topic_entity_id)
+    rounds = [
+        Round(id=round_id, used_topic_entities=' '.join(map(str, topic_entity_ids)))
+        for round_id, topic_entity_ids in used.items()
+    ]
+    Round.objects.bulk_update(rounds, ['used_topic_entities'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0044_player_score_sums'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='round',
+            name='used_topic_entities',
+            field=models.TextField(blank=True, verbose_name='Использованные сущности'),
+        ),
+        migrations.RunPython(fill_used_topic_entities, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='round',
+            name='bot_answers',
+        ),
+    ]
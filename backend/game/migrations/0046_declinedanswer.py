@@ -0,0 +1,44 @@
+# Generated by Django 4.2 on 2026-10-18 06:01
+
+from django.db import migrations, models
+import django.db.models.deletion
+import json
+
+
+def copy_declined_answers(apps, schema_editor):
+    DeclinedAnswer = apps.get_model('game', 'DeclinedAnswer')
+    Round = apps.get_model('game', 'Round')
+    declined_answers = []
+    rounds = Round.objects.exclude(declined_answers='[]').values_list('id', 'declined_answers')
+    for round_id, round_declined_answers in rounds.iterator(chunk_size=1000):
+        for text, entity_title in json.loads(round_declined_answers):
+            declined_answers.append(DeclinedAnswer(round_id=round_id, text=text, entity_title=entity_title[:100]))
+    DeclinedAnswer.objects.bulk_create(declined_answers, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0045_round_used_topic_entities'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeclinedAnswer',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('text', models.TextField(verbose_name='Ответ')),
+                ('entity_title', models.CharField(max_length=100, verbose_name='Сущность или причина')),
+                ('sent_at', models.DateTimeField(auto_now_add=True, verbose_name='Отправлен')),
+                ('round', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='declined_answers', to='game.round', verbose_name='Раунд')),
+            ],
+            options={
+                'ordering': ['id'],
+            },
+        ),
+        migrations.RunPython(copy_declined_answers, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='round',
+            name='declined_answers',
+        ),
+    ]
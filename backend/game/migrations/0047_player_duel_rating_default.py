@@ -0,0 +1,25 @@
+# Generated by Django 4.2 on 2026-10-18 06:02
+
+from django.db import migrations, models
+
+
+def set_initial_duel_rating(apps, schema_editor):
+    # Duel ratings were never computed; replay_duel_ratings derives them from the duel history
+    Player = apps.get_model('game', 'Player')
+    Player.objects.update(duel_rating=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0046_declinedanswer'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='player',
+            name='duel_rating',
+            field=models.PositiveSmallIntegerField(default=1000, verbose_name='Дуэльный рейтинг'),
+        ),
+        migrations.RunPython(set_initial_duel_rating, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 4.2 on 2026-10-18 06:06
+
+from collections import defaultdict
+
+from django.db import migrations, models
+
+
+def fill_played_topics(apps, schema_editor):
+    Player = apps.get_model('game', 'Player')
+    Round = apps.get_model('game', 'Round')
+    played = defaultdict(dict)
+    rounds = Round.objects.order_by('id').values_list('player1_id', 'player2_id', 'topic_id')
+    for player1_id, player2_id, topic_id in rounds.iterator(chunk_size=10000):
+        for player_id in (player1_id, player2_id):
+            if player_id:
+                played[player_id][topic_id] = None
+    players = [
+        Player(id=player_id, played_topics=' '.join(map(str, topic_ids)))
+        for player_id, topic_ids in played.items()
+    ]
+    Player.objects.bulk_update(players, ['played_topics'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0047_player_duel_rating_default'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='player',
+            name='played_topics',
+            field=models.TextField(blank=True, verbose_name='Сыгранные темы'),
+        ),
+        migrations.RunPython(fill_played_topics, migrations.RunPython.noop),
+    ]
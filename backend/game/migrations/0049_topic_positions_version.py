@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-18 06:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0048_player_played_topics'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='topic',
+            name='positions_version',
+            field=models.PositiveIntegerField(default=0, verbose_name='Версия мест и счётчиков ответов'),
+        ),
+    ]
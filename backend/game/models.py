@@ -1,82 +1,76 @@
-import itertools
 import json
-import re
+import math
 from collections import defaultdict
-from random import choice
 from typing import Optional
 
 from django.contrib import admin
-from django.db import models
-from django.db.models import Avg, F, Q, Sum
+from django.db import models, transaction
+from django.db.models import Case, Count, ExpressionWrapper, F, FloatField, Max, Min, Q, Sum, Value, When, Window
+from django.db.models.functions import Cast, Concat, RowNumber
 from django.http import Http404
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
-import jellyfish
+
+from .counters import get_answer_counts
+from .jobs import enqueue, run_after_response
+from .leaderboard import get_leaderboard
+from .matching import (
+    Normalizer, expand_pattern, get_negative_cache, get_normalizer, get_topic_index, get_topic_stamp
+)
+from .offers import get_topic_offers
+from .sampling import get_bot_sampler, get_topic_pool
 
 
 class Config:
+    answer_counts_flush_interval: int = 5
     attempts_count: int = 5
+    # Exponent of the answer counts in the bot's choice, by player level: the higher, the more popular its answers
+    bot_strengths: tuple[float] = (0.25, 0.5, 0.75, 1, 1.5, 2)
+    bot_sampler_ttl: int = 60
     draw_rating_bonus = 20
+    duel_elo_k: int = 32
+    duel_initial_rating: int = 1000
     fading_rating_coef = 0.03
     initial_rounds: int = 11
+    max_match_batch_size: int = 100
+    max_pattern_spellings: int = 1000
+    negative_cache_size: int = 1000
     points: tuple[int] = (10, 9, 8, 7, 6, 5, 4, 3, 2, 1)
     topic_levels: tuple[int] = (0, 6, 12, 18, 24, 40)
+    topic_offers_count: int = 2
+    topic_offers_ttl: int = 86400
+    topic_pool_ttl: int = 60
     topics_count: int = 3
     victory_rating_bonus = 40
 
 
-def remove_successive_letters(s: str) -> str:
-    result = []
-    for char, group in itertools.groupby(s):
-        if char.isdigit() or char in 'ix+':
-            result.extend(list(group))
-        else:
-            result.append(char)
-    return ''.join(result)
-
-
-def simplify_text(text: str, odd_words: list[str] = [], extra_allowed_symbols: str = '') -> str:
-    text = text.lower().replace('э', 'е').replace('ё', 'е').replace('й', 'и')
-    text = ''.join(char for char in text if char.isalnum() or char in extra_allowed_symbols)
-    text = remove_successive_letters(text)
-    for word in odd_words:
-        text = text.replace(word, '')
-    return text
-
-
 class TopicQuerySet(models.QuerySet):
 
     def assigned_to(self, player: 'Player'):
         return self.filter(id__in=player.assigned_topics.split())
 
-    def exclude_played_by(self, player: 'Player'):
-        return self.exclude(
-            id__in=Round.objects.filter(Q(player1=player) | Q(player2=player)).values_list('topic_id')
-        )
-
     def for_level(self, level: int):
-        ranges = len(Config.topic_levels) - 1
-        min_topic_level = max(1, level - 2)
-        max_topic_level = min(ranges, level + 2)
-        min_average_score = Config.topic_levels[ranges - max_topic_level]
-        max_average_score = Config.topic_levels[ranges + 1 - min_topic_level]
+        min_average_score, max_average_score = Topic.get_level_scores(level)
         return self.filter(
             average_score__gte=min_average_score,
             average_score__lte=max_average_score
         )
 
-    def random(self, count: int):
-        return self.order_by('?')[:count]
-
 
 class Topic(models.Model):
     title = models.CharField('Название', max_length=100, unique=True)
     hint = models.TextField('Подсказка', blank=True)
-    matches = models.TextField('Словарь совпадений', default='{}')
     exclusions = models.CharField('Исключаемые слова', max_length=100, blank=True)
+    extra_allowed_symbols = models.CharField('Дополнительные допустимые символы', max_length=20, blank=True)
     average_score = models.FloatField('Средний результат', default=0)
     average_score_hits_mode = models.FloatField('Средний результат в хитах', default=0)
+    score_sum = models.PositiveIntegerField('Сумма результатов', default=0)
+    rounds_count = models.PositiveIntegerField('Число завершённых раундов', default=0)
+    score_sum_hits_mode = models.PositiveIntegerField('Сумма результатов в хитах', default=0)
+    rounds_count_hits_mode = models.PositiveIntegerField('Число завершённых раундов в хитах', default=0)
     bot_answers = models.TextField('Список ответов бота', default='{}')
+    matches_version = models.PositiveIntegerField('Версия словаря совпадений', default=0)
+    positions_version = models.PositiveIntegerField('Версия мест и счётчиков ответов', default=0)
 
     objects = TopicQuerySet.as_manager()
 
@@ -86,6 +80,43 @@ class Topic(models.Model):
     def __str__(self) -> str:
         return self.title
 
+    def save(self, *args, **kwargs) -> None:
+        adding = self._state.adding
+        super().save(*args, **kwargs)
+        if adding:
+            # Prepared offers never include the new topic, so all of them are dropped
+            transaction.on_commit(lambda: get_topic_offers(Config.topic_offers_ttl).bump_version())
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        transaction.on_commit(lambda: get_topic_offers(Config.topic_offers_ttl).bump_version())
+        return result
+
+    @staticmethod
+    def get_level_scores(level: int) -> tuple[int, int]:
+        # Average scores of the topics suitable for the player level
+        ranges = len(Config.topic_levels) - 1
+        min_topic_level = max(1, level - 2)
+        max_topic_level = min(ranges, level + 2)
+        return Config.topic_levels[ranges - max_topic_level], Config.topic_levels[ranges + 1 - min_topic_level]
+
+    @classmethod
+    def get_random(cls, count: int, excluded_ids: set[int], levels: list[int] = ()) -> list['Topic']:
+        # Sampled from the per-worker pool of topic ids instead of sorting the table with ORDER BY random().
+        # Suitable for all the levels if there are enough such topics, any unplayed topics otherwise
+        pool = get_topic_pool(Config.topic_pool_ttl)
+        scores = [cls.get_level_scores(level) for level in levels]
+        ids = pool.sample(
+            count,
+            excluded_ids,
+            max((min_score for min_score, _ in scores), default=-math.inf),
+            min((max_score for _, max_score in scores), default=math.inf)
+        )
+        if len(ids) < count:
+            ids = pool.sample(count, excluded_ids)
+        topics = cls.objects.in_bulk(ids)
+        return [topics[topic_id] for topic_id in ids if topic_id in topics]
+
     @classmethod
     def find(cls, topic_id: int = 0, title: str = '') -> Optional['Topic']:
         try:
@@ -108,52 +139,188 @@ class Topic(models.Model):
         self.save()
 
     def gather_matches(self) -> None:
-        matches = defaultdict(set)
-        odd_words = self.exclusions.split()
-        for entity in self.entities.all():
-            for match in entity.matches.split():
-                matches[match].add(entity.id)
-                for word in odd_words:
-                    match = match.replace(word, '')
-                matches[match].add(entity.id)
-        matches = {match: list(ids) for match, ids in matches.items()}
-        self.matches = json.dumps(matches, ensure_ascii=False)
-        self.save()
+        matches = {match for entity in self.entities.all() for match in self.get_entity_matches(entity)}
+        self.sync_matches(matches, self.topic_matches.all())
+        get_topic_index(self)
+
+    def get_entity_matches(self, entity: 'Entity') -> set[tuple[str, int, bool]]:
+        if entity.uses_automaton:
+            return {(entity.pattern, entity.id, True)}
+        normalizer = self.get_normalizer()
+        matches = set()
+        for match in entity.matches.split():
+            matches.add((match, entity.id, False))
+            matches.add((normalizer.remove_odd_words(match), entity.id, False))
+        return matches
+
+    def remove_entity_matches(self, entity_id: int) -> None:
+        self.sync_matches(set(), self.topic_matches.filter(entity_id=entity_id))
+
+    def sync_matches(self, matches: set[tuple[str, int, bool]], queryset: models.QuerySet) -> None:
+        existing_matches = {match[1:]: match[0] for match in queryset.values_list(
+            'id', 'key', 'entity_id', 'automaton'
+        )}
+        obsolete_matches = {match: match_id for match, match_id in existing_matches.items() if match not in matches}
+        new_matches = matches - existing_matches.keys()
+        if not obsolete_matches and not new_matches:
+            return
+        index = get_topic_index(self, build=False)
+        previous_version = self.matches_version
+
+        def update_index():
+            self.refresh_from_db(fields=['matches_version'])
+            if index and self.matches_version == previous_version + 1:
+                # Nobody else changed the topic meanwhile, so this worker's index can be patched instead of rebuilt
+                index.update(obsolete_matches, new_matches, get_topic_stamp(self))
+
+        with transaction.atomic():
+            TopicMatch.objects.filter(id__in=obsolete_matches.values()).delete()
+            # A concurrent sync may have inserted the same rows already
+            TopicMatch.objects.bulk_create(
+                [
+                    TopicMatch(topic=self, key=key, entity_id=entity_id, automaton=automaton)
+                    for key, entity_id, automaton in new_matches
+                ],
+                ignore_conflicts=True
+            )
+            Topic.objects.filter(id=self.id).update(matches_version=F('matches_version') + 1)
+            transaction.on_commit(update_index, robust=True)
+        enqueue('rematch_unbound_answers', self.id, key=f'rematch-topic-{self.id}')
+
+    def rematch_unbound_answers(self, chunk_size: int = 500) -> int:
+        answers = Answer.objects.unbound().filter(round__topic=self).order_by('id')
+        bound_count = 0
+        last_id = 0
+        while chunk := list(answers.filter(id__gt=last_id)[:chunk_size]):
+            last_id = chunk[-1].id
+            matches = Topic.get_matching_entities_bulk([(self.id, answer.text) for answer in chunk])
+            bindings = [
+                (answer, topic_entities[0])
+                for answer, topic_entities in zip(chunk, matches) if len(topic_entities) == 1
+            ]
+            if bindings:
+                bound_count += Answer.bind(bindings)
+        return bound_count
 
-    def get_matching_entities(self, text: str) -> Optional[list['TopicEntity']]:
-        extra_allowed_symbols = ''
-        if self.title == 'Языки программирования':
-            extra_allowed_symbols = '+#'
-        text = simplify_text(text, odd_words=self.exclusions.split(), extra_allowed_symbols=extra_allowed_symbols)
-        matches = json.loads(self.matches)
-        if text in matches:
-            return list(TopicEntity.objects.filter(entity__id__in=matches[text], topic=self))
+    def update_entity_matches(self, entity: 'Entity') -> None:
+        self.sync_matches(self.get_entity_matches(entity), self.topic_matches.filter(entity_id=entity.id))
+
+    def get_normalizer(self) -> Normalizer:
+        return get_normalizer(self.exclusions, self.extra_allowed_symbols)
+
+    @classmethod
+    def get_matching_entities_bulk(cls, items: list[tuple[int, str]]) -> list[list['TopicEntity']]:
+        topics = cls.objects.in_bulk({topic_id for topic_id, _ in items})
         matching_ids = []
-        for match in matches:
-            if jellyfish.damerau_levenshtein_distance(match, text) <= 1:
-                matching_ids += matches[match]
+        for topic_id, text in items:
+            topic = topics.get(topic_id)
+            matching_ids.append(get_topic_index(topic).lookup(text) if topic else [])
+        topic_entities = defaultdict(list)
+        queryset = TopicEntity.objects.filter(
+            topic_id__in=topics,
+            entity_id__in={entity_id for ids in matching_ids for entity_id in ids}
+        ).select_related('entity')
+        for topic_entity in queryset:
+            topic_entities[topic_entity.topic_id, topic_entity.entity_id].append(topic_entity)
+        return [
+            [te for entity_id in dict.fromkeys(ids) for te in topic_entities[topic_id, entity_id]]
+            for (topic_id, _), ids in zip(items, matching_ids)
+        ]
+
+    def get_matching_entities(self, text: str) -> Optional[list['TopicEntity']]:
+        normalizer = self.get_normalizer()
+        text = normalizer.simplify(text)
+        negative_cache = get_negative_cache(self, Config.negative_cache_size)
+        if text in negative_cache:
+            return None
+        index = get_topic_index(self, build=False)
+        if index is None:
+            # Until the index is built, exact keys and the (rare) automaton entities come in one indexed query
+            topic_entities = list(TopicEntity.objects.select_related('entity').filter(
+                Q(entity__topic_matches__key=text, entity__topic_matches__automaton=False) |
+                Q(entity__topic_matches__automaton=True),
+                topic=self,
+                entity__topic_matches__topic=self
+            ).annotate(automaton=F('entity__topic_matches__automaton')))
+            if topic_entities and not any(topic_entity.automaton for topic_entity in topic_entities):
+                return topic_entities
+            # Automata are kept compiled in the index rather than loaded again for every answer
+            index = get_topic_index(self)
+        matching_ids = index.lookup_exact(text) or index.lookup_similar(text)
         if matching_ids:
-            return list(TopicEntity.objects.filter(entity__id__in=matching_ids, topic=self))
+            return list(TopicEntity.objects.select_related('entity').filter(entity__id__in=matching_ids, topic=self))
+        negative_cache.add(text)
         return None
 
+    def lock(self) -> None:
+        # Serializes changes of the topic's aggregates and entity positions; call inside a transaction
+        Topic.objects.select_for_update().filter(id=self.id).exists()
+
+    def reconcile_answers_counts(self) -> int:
+        # Rebuilds the counters from the answers: the initial count plus the bound answers that counted
+        counts = dict(
+            Answer.objects.bound().filter(Q(player=1) | Q(round__duel=True), topic_entity__topic=self)
+            .values('topic_entity').annotate(count=Count('id')).values_list('topic_entity', 'count')
+        )
+        with transaction.atomic():
+            self.lock()
+            topic_entities = list(self.topic_entities.select_for_update())
+            drifted = []
+            for topic_entity in topic_entities:
+                answers_count = topic_entity.initial_count + counts.get(topic_entity.id, 0)
+                if topic_entity.answers_count != answers_count:
+                    topic_entity.answers_count = answers_count
+                    drifted.append(topic_entity)
+            TopicEntity.objects.bulk_update(drifted, ['answers_count'])
+            self.update_entities_positions()
+        return len(drifted)
+
     def update_entities_positions(self) -> None:
-        queryset = list(TopicEntity.objects.filter(topic=self).order_by('-answers_count'))
-        for i, entity in enumerate(queryset, start=1):
-            entity.position = i
-        TopicEntity.objects.bulk_update(queryset, ['position'])
+        with transaction.atomic():
+            self.lock()
+            queryset = list(TopicEntity.objects.filter(topic=self).order_by('-answers_count', 'position'))
+            for i, entity in enumerate(queryset, start=1):
+                entity.position = i
+            TopicEntity.objects.bulk_update(queryset, ['position'])
+            self.bump_positions_version()
+
+    def bump_positions_version(self) -> None:
+        # Per-worker bot samplers keep positions and answer counts until the version changes
+        Topic.objects.filter(id=self.id).update(positions_version=F('positions_version') + 1)
+
+    def add_round_score(self, score: int, hits_mode: bool = False) -> None:
+        # SET expressions see the row before the update, so the average is taken over the new sum and count.
+        # Not idempotent: Round.finish calls it only after its conditional UPDATE has claimed the round
+        suffix = '_hits_mode' if hits_mode else ''
+        Topic.objects.filter(id=self.id).update(**{
+            f'score_sum{suffix}': F(f'score_sum{suffix}') + score,
+            f'rounds_count{suffix}': F(f'rounds_count{suffix}') + 1,
+            f'average_score{suffix}': Cast(F(f'score_sum{suffix}') + score, FloatField()) /
+            (F(f'rounds_count{suffix}') + 1)
+        })
 
     # TODO duels
     def update_statistics(self) -> None:
-        self.average_score = self.rounds.finished().points_mode().aggregate(avg=Avg('score1'))['avg'] or 0
-        self.average_score_hits_mode = self.rounds.finished().hits_mode().aggregate(avg=Avg('score1'))['avg'] or 0
-        self.save()
-        self.update_entities_positions()
+        with transaction.atomic():
+            # The lock orders this against add_round_score of rounds finishing meanwhile
+            self.lock()
+            for suffix, rounds in (('', self.rounds.points_mode()), ('_hits_mode', self.rounds.hits_mode())):
+                aggregate = rounds.finished().aggregate(score_sum=Sum('score1'), rounds_count=Count('id'))
+                score_sum, rounds_count = aggregate['score_sum'] or 0, aggregate['rounds_count']
+                setattr(self, f'score_sum{suffix}', score_sum)
+                setattr(self, f'rounds_count{suffix}', rounds_count)
+                setattr(self, f'average_score{suffix}', score_sum / rounds_count if rounds_count else 0)
+            self.save(update_fields=[
+                'score_sum', 'rounds_count', 'average_score',
+                'score_sum_hits_mode', 'rounds_count_hits_mode', 'average_score_hits_mode'
+            ])
 
 
 class Entity(models.Model):
     title = models.CharField('Название', max_length=100, unique=True)
     pattern = models.CharField('Паттерн', max_length=100)
     matches = models.TextField('Список совпадений', blank=True)
+    updated_at = models.DateTimeField('Изменена', auto_now=True, null=True)
     topics = models.ManyToManyField(Topic, through='TopicEntity', related_name='entities')
 
     class Meta:
@@ -166,110 +333,18 @@ class Entity(models.Model):
     def compile_pattern(self, pattern: str | None = None) -> None:
         if pattern:
             self.pattern = pattern
-
-        matches: list[str] = []
-
-        # Replace spaces into '|' inside bracket groups
-        pattern: str = re.sub(
-            r'\(([^)]*)\)',
-            lambda match: f'({match.group(1).replace(" ", "|")})',
-            self.pattern
-        )
-
-        if ' = ' in pattern:
-            pattern, obligatory_combinations = pattern.split(' = ')
-            obligatory_combinations: list[tuple[int, ...]] = [
-                tuple(int(num) - 1 for num in combination) for combination in obligatory_combinations.split()
-            ]
-
-        def permutate(list_: list[str]) -> list[str]:
-            if not list_:
-                return ['']
-            head, *tail = list_
-            tail_expanded = permutate(tail)
-            if isinstance(head, list):
-                return [item + tail_item for item in head for tail_item in tail_expanded]
-            else:
-                return [head + tail_item for tail_item in tail_expanded]
-
-        def parse_bracket_group(item: str) -> list[str]:
-            if len(item) == 1:
-                return [item, '']
-            elif '|' in item:
-                return item.split('|')
-            return list(item)
-
-        def parse_ordinal(item: str) -> list[str]:
-            num = int(item[:-1])
-            if num > 30:
-                return [item]
-            male: bool = item[-1] == 'и'
-            male_ordinals = [
-                'нулевой', 'первыи', 'второи', 'трети', 'четвертыи', 'пятыи', 'шестои', 'седьмои', 'восьмои', 'девятыи',
-                'десятыи', 'одинадцатыи', 'двенадцатыи', 'тринадцатыи', 'четырнадцатыи', 'пятнадцатыи', 'шестнадцатыи',
-                'семнадцатыи', 'восемнадцатыи', 'девятнадцатыи', 'двадцатыи', 'двадцатьпервыи', 'двадцатьвторои',
-                'двадцатьтрети', 'двадцатьчетвертыи', 'двадцатьпятыи', 'двадцатьшестои', 'двадцатьседьмои',
-                'двадцатьвосьмои', 'двадцатьдевятыи', 'тридцатыи'
-            ]
-            female_ordinals = [
-                'нулевая', 'первая', 'вторая', 'третья', 'четвертая', 'пятая', 'шестая', 'седьмая', 'восьмая',
-                'девятая', 'десятая', 'одинадцатая', 'двенадцатая', 'тринадцатая', 'четырнадцатая', 'пятнадцатая',
-                'шестнадцатая', 'семнадцатая', 'восемнадцатая', 'девятнадцатая', 'двадцатая', 'двадцатьпервая',
-                'двадцатьвторая', 'двадцатьтретья', 'двадцатьчетвертая', 'двадцатьпятая', 'двадцатьшестая',
-                'двадцатьседьмая', 'двадцатьвосьмая', 'двадцатьдевятая', 'тридцатая'
-            ]
-            roman_numbers = [
-                '', 'i', 'ii', 'iii', 'iv', 'v', 'vi', 'vii', 'viii', 'ix', 'x', 'xi', 'xii', 'xiii', 'xiv', 'xv',
-                'xvi', 'xvii', 'xviii', 'xix', 'xx', 'xxi', 'xxii', 'xxiii', 'xxiv', 'xxv', 'xxvi', 'xxvii', 'xxvii',
-                'xxix', 'xxx'
-            ]
-            return [
-                str(num),
-                roman_numbers[num],
-                male_ordinals[num] if male else female_ordinals[num]
-            ]
-
-        if 'obligatory_combinations' in locals():
-            compound_pattern: list[str] = []
-            for combination in obligatory_combinations:
-                splitted_pattern: list[str] = []
-                for n, item in enumerate(pattern.split()):
-                    splitted_pattern.append(item if n in combination else f'*{item}')
-                compound_pattern.append(' '.join(splitted_pattern))
-        else:
-            compound_pattern: list[str] = pattern.split(' / ')
-
-        for pattern in compound_pattern:
-            splitted_pattern: list[str] = pattern.split()
-            submatches: list[str] = []
-            for item in splitted_pattern:
-                if item.startswith('(') and item.endswith(')') and ')' not in item[1:-1]:
-                    submatches.append(parse_bracket_group(item[1:-1]))
-                elif item.startswith('*(') and item.endswith(')') and ')' not in item[1:-1]:
-                    submatches.append(parse_bracket_group(item[2:-1]) + [''])
-                else:
-                    add_empty = False
-                    if item.startswith('*'):
-                        item = item[1:]
-                        add_empty = True
-                    if re.match(r'^\d+[ия]$', item):
-                        splitted_item: list[str] = parse_ordinal(item)
-                    else:
-                        splitted_item: list[str] = item.replace('(', ' (').replace(')', ') ').split()
-                        for n, subitem in enumerate(splitted_item):
-                            if subitem.startswith('(') and subitem.endswith(')') and ')' not in subitem[1:-1]:
-                                splitted_item[n] = parse_bracket_group(subitem[1:-1])
-                            else:
-                                splitted_item[n] = subitem
-                        splitted_item = permutate(splitted_item)
-                    if add_empty:
-                        splitted_item.append('')
-                    submatches.append(splitted_item)
-            matches.extend(permutate(submatches))
-
-        matches = [remove_successive_letters(item) for item in list(set(matches)) if item]
-        self.matches = ' '.join(sorted(matches))
+        matches = expand_pattern(self.pattern, Config.max_pattern_spellings)
+        if matches == self.matches and not self.uses_automaton:
+            self.save()
+            return
+        self.matches = matches
         self.save()
+        for topic in self.topics.all():
+            topic.update_entity_matches(self)
+
+    @property
+    def uses_automaton(self) -> bool:
+        return bool(self.pattern) and not self.matches
 
     def update_title_and_pattern(self, title: str, pattern: str) -> None:
         if self.title != title:
@@ -294,9 +369,71 @@ class TopicEntity(models.Model):
     def __str__(self) -> str:
         return f'{self.topic} — {self.entity}'
 
-    def increment_answers_count(self) -> None:
-        self.answers_count += 1
-        self.save()
+    def count_answer(self) -> None:
+        # Hits are buffered after the commit. A shared buffer is written by the flush_answer_counts job once
+        # per flush interval; the in-process one right away, as no other process could flush it.
+        # A failing flush is logged rather than failing the request, and its counts stay buffered
+        def add() -> None:
+            answer_counts = get_answer_counts()
+            answer_counts.add(self.id)
+            if not answer_counts.shared:
+                TopicEntity.flush_answer_counts()
+            elif answer_counts.claim_flush(Config.answer_counts_flush_interval):
+                enqueue('flush_answer_counts', key='flush-answer-counts', delay=Config.answer_counts_flush_interval)
+        transaction.on_commit(add, robust=True)
+
+    def increment_answers_count(self, increment: int = 1) -> None:
+        # Positions stay sorted by answers_count, so the entity only overtakes the entities in front of it
+        # that now have fewer answers; they move one place down and nothing else is written.
+        # Call with the topic locked
+        self.refresh_from_db(fields=['answers_count', 'position'])
+        self.answers_count += increment
+        new_position = TopicEntity.objects.filter(
+            topic_id=self.topic_id,
+            position__lt=self.position,
+            answers_count__lt=self.answers_count
+        ).aggregate(position=Min('position'))['position']
+        if new_position:
+            TopicEntity.objects.filter(
+                topic_id=self.topic_id,
+                position__gte=new_position,
+                position__lt=self.position
+            ).update(position=F('position') + 1)
+            self.position = new_position
+        self.save(update_fields=['answers_count', 'position'])
+
+    @classmethod
+    def flush_answer_counts(cls) -> int:
+        answer_counts = get_answer_counts()
+        counts = answer_counts.take()
+        if not counts:
+            return 0
+        try:
+            with transaction.atomic():
+                ids_by_topic = defaultdict(list)
+                for topic_entity_id, topic_id in cls.objects.filter(id__in=counts).values_list('id', 'topic_id'):
+                    ids_by_topic[topic_id].append(topic_entity_id)
+                # Topics are locked in id order, as concurrent flushes may share some of them
+                for topic_id in sorted(ids_by_topic):
+                    topic = Topic(id=topic_id)
+                    topic.lock()
+                    positions = cls.objects.filter(topic_id=topic_id).aggregate(count=Count('id'), last=Max('position'))
+                    if positions['last'] == positions['count']:
+                        for topic_entity in cls.objects.filter(id__in=ids_by_topic[topic_id]).order_by('id'):
+                            topic_entity.increment_answers_count(counts[topic_entity.id])
+                        topic.bump_positions_version()
+                        continue
+                    # Entities added since the last sort have no place yet, so the topic is re-sorted fully
+                    for topic_entity_id in ids_by_topic[topic_id]:
+                        cls.objects.filter(id=topic_entity_id).update(
+                            answers_count=F('answers_count') + counts[topic_entity_id]
+                        )
+                    topic.update_entities_positions()
+        except Exception:
+            # Taken counts are put back, so the next flush or the job retry writes them
+            answer_counts.add_many(counts)
+            raise
+        return len(counts)
 
     @property
     def points(self) -> int:
@@ -309,13 +446,29 @@ class TopicEntity(models.Model):
         return round(self.answers_count / (self.topic.rounds.count() + Config.initial_rounds), 2)
 
 
+class TopicMatch(models.Model):
+    topic = models.ForeignKey(Topic, verbose_name='Тема', on_delete=models.CASCADE, related_name='topic_matches')
+    key = models.TextField('Ключ')
+    entity = models.ForeignKey(Entity, verbose_name='Сущность', on_delete=models.CASCADE, related_name='topic_matches')
+    automaton = models.BooleanField('Ключ — паттерн для автомата', default=False)
+
+    class Meta:
+        unique_together = ['topic', 'key', 'entity']
+        verbose_name_plural = 'topic matches'
+
+    def __str__(self) -> str:
+        return f'{self.topic} — {self.key}'
+
+
 class PlayerQuerySet(models.QuerySet):
     def inactive(self):
         one_week_ago = timezone.now() - timezone.timedelta(weeks=1)
         return self.exclude(rounds__started_at__gte=one_week_ago)
 
-    def top(self, count: int = 10):
-        return self.order_by('-rating')[:count]
+    def top(self, count: int = 10, field: str = 'rating') -> list['Player']:
+        ids = get_leaderboard(field).top(count)
+        players = self.in_bulk(ids)
+        return [players[player_id] for player_id in ids if player_id in players]
 
 
 class Player(models.Model):
@@ -334,8 +487,13 @@ class Player(models.Model):
     duel_defeats = models.PositiveSmallIntegerField('Число поражений в дуэлях', default=0)
     duel_draws = models.PositiveSmallIntegerField('Число ничьих в дуэлях', default=0)
     duel_average_score = models.PositiveSmallIntegerField('Среднее число очков в дуэлях', default=0)
-    duel_rating = models.PositiveSmallIntegerField('Дуэльный рейтинг', default=0)
+    duel_rating = models.PositiveSmallIntegerField('Дуэльный рейтинг', default=Config.duel_initial_rating)
+    score_sum = models.PositiveIntegerField('Сумма очков', default=0)
+    rounds_count = models.PositiveIntegerField('Число завершённых раундов', default=0)
+    duel_score_sum = models.PositiveIntegerField('Сумма очков в дуэлях', default=0)
+    duel_rounds_count = models.PositiveIntegerField('Число завершённых дуэлей', default=0)
     assigned_topics = models.CharField('Список назначенных тем', max_length=20)
+    played_topics = models.TextField('Сыгранные темы', blank=True)
     referrer = models.ForeignKey(
         'Player',
         verbose_name='Реферер',
@@ -353,6 +511,23 @@ class Player(models.Model):
             name += f' @{self.telegram_username}'
         return name
 
+    def save(self, *args, **kwargs) -> None:
+        super().save(*args, **kwargs)
+        # A leaderboard that cannot be written does not fail the save; rebuild_leaderboard catches it up
+        update_fields = kwargs.get('update_fields')
+        player_id, rating, duel_rating = self.id, self.rating, self.duel_rating
+        if update_fields is None or 'rating' in update_fields:
+            transaction.on_commit(lambda: get_leaderboard().set(player_id, rating), robust=True)
+        if self.duel_rounds_count and (update_fields is None or 'duel_rating' in update_fields):
+            transaction.on_commit(lambda: get_leaderboard('duel_rating').set(player_id, duel_rating), robust=True)
+
+    def delete(self, *args, **kwargs):
+        player_id = self.id
+        result = super().delete(*args, **kwargs)
+        transaction.on_commit(lambda: get_leaderboard().remove(player_id), robust=True)
+        transaction.on_commit(lambda: get_leaderboard('duel_rating').remove(player_id), robust=True)
+        return result
+
     @classmethod
     def find_or_create(cls, **kwargs) -> Optional['Player']:
         if 'player_id' in kwargs:
@@ -370,66 +545,230 @@ class Player(models.Model):
             )
             if player.telegram_username != kwargs['telegram_username']:
                 player.telegram_username = kwargs['telegram_username']
-                player.save()
+                player.save(update_fields=['telegram_username'])
             if player.name != kwargs['name']:
                 player.name = kwargs['name']
-                player.save()
+                player.save(update_fields=['name'])
         return player
 
+    def get_played_topic_ids(self) -> set[int]:
+        return {int(topic_id) for topic_id in self.played_topics.split()}
+
+    @staticmethod
+    def refill_topic_offers(player_ids: list[int], after_response: bool = False) -> None:
+        # Shared offers are prepared by the job worker. In-process ones would stay in the worker's memory,
+        # so this process prepares them itself once the caller's transaction is committed, or once
+        # the response is sent if the request should not wait for them
+        if get_topic_offers(Config.topic_offers_ttl).shared:
+            for player_id in player_ids:
+                enqueue('fill_topic_offers', player_id, key=f'fill-topic-offers:{player_id}')
+            return
+
+        def fill() -> None:
+            for player in Player.objects.filter(id__in=player_ids):
+                player.fill_topic_offers()
+        if after_response:
+            transaction.on_commit(lambda: run_after_response(fill), robust=True)
+        else:
+            transaction.on_commit(fill, robust=True)
+
+    def fill_topic_offers(self) -> None:
+        # A few offers prepared ahead, so /random-topics only has to pop one
+        topic_offers = get_topic_offers(Config.topic_offers_ttl)
+        version = topic_offers.get_version()
+        played_ids = self.get_played_topic_ids()
+        offers = []
+        for _ in range(Config.topic_offers_count):
+            topics = Topic.get_random(Config.topics_count, played_ids, [self.level])
+            if topics:
+                offers.append([(topic.id, topic.title) for topic in topics])
+        topic_offers.replace(self.id, version, offers)
+
+    def pop_topic_offer(self) -> list[Topic] | None:
+        # Offers with topics played after they were prepared are skipped; when none is left,
+        # the caller samples the topics itself and the next offers are prepared after the response
+        played_ids = self.get_played_topic_ids()
+        topic_offers = get_topic_offers(Config.topic_offers_ttl)
+        while (offer := topic_offers.pop(self.id)) is not None:
+            if not any(topic_id in played_ids for topic_id, _ in offer):
+                return [Topic(id=topic_id, title=title) for topic_id, title in offer]
+        self.refill_topic_offers([self.id], after_response=True)
+        return None
+
     def assign_topics(self, topics: list[Topic]) -> None:
         self.assigned_topics = ' '.join([str(topic.id) for topic in topics])
-        self.save()
+        self.save(update_fields=['assigned_topics'])
 
     def clear_assigned_topics(self) -> None:
         self.assigned_topics = ''
-        self.save()
+        self.save(update_fields=['assigned_topics'])
+
+    def add_round(self, round_: 'Round', side: int = 1) -> int:
+        # Advances the counters that update_statistics recounts; runs in the transaction of Round.finish
+        prefix = 'duel_' if round_.duel else ''
+        fields = [f'{prefix}score_sum', f'{prefix}rounds_count', f'{prefix}{round_.get_result(side)}']
+        with transaction.atomic():
+            Player.objects.select_for_update().filter(id=self.id).exists()
+            self.refresh_from_db(fields=[*fields, 'rating', 'best_rating'])
+            setattr(self, fields[0], getattr(self, fields[0]) + getattr(round_, f'score{side}'))
+            setattr(self, fields[1], getattr(self, fields[1]) + 1)
+            setattr(self, fields[2], getattr(self, fields[2]) + 1)
+            setattr(self, f'{prefix}average_score', round(getattr(self, fields[0]) / getattr(self, fields[1])))
+            fields.append(f'{prefix}average_score')
+            if not round_.duel:
+                # Duels change neither the level nor the rating; Round.update_duel_ratings updates their Elo rating
+                self.update_level()
+                fields.append('level')
+                fields += self.update_rating()
+            self.save(update_fields=fields)
+        return self.rating
 
     def update_statistics(self, full: bool = False) -> int:
-        if full or not self.rounds.last().duel:
+        # Recount from the whole history; Round.finish keeps the same fields current through add_round.
+        # Only the recounted fields are saved: played_topics is appended in SQL by Round.add_to_played_topics
+        # and an instance loaded earlier would write back the topics it had then
+        last_round = self.rounds.first()
+        fields = []
+        if full or not (last_round and last_round.duel):
             finished_chatgpt_rounds = self.rounds.chatgpt().finished()
-            self.average_score = round(finished_chatgpt_rounds.aggregate(avg=Avg('score1'))['avg'] or 0)
+            aggregate = finished_chatgpt_rounds.aggregate(score_sum=Sum('score1'), rounds_count=Count('id'))
+            self.score_sum = aggregate['score_sum'] or 0
+            self.rounds_count = aggregate['rounds_count']
+            self.average_score = round(self.score_sum / self.rounds_count) if self.rounds_count else 0
             self.victories = finished_chatgpt_rounds.victories().count()
             self.defeats = finished_chatgpt_rounds.defeats().count()
             self.draws = finished_chatgpt_rounds.draws().count()
-            rating = 0
-            for round_ in self.rounds.chatgpt().last_finished(10):
-                round_rating = round_.score1
-                if round_.outcome == '1':
-                    round_rating += Config.victory_rating_bonus
-                elif round_.outcome == '=':
-                    round_rating += Config.draw_rating_bonus
-                days = (timezone.now().date() - round_.finished_at.date()).days
-                aging_coef = max(0, 1 - days*Config.fading_rating_coef)
-                rating += round_rating * aging_coef
-            self.rating = round(rating)
-            for i, value in enumerate(Config.topic_levels):
-                if self.average_score < value:
-                    self.level = i
-                    break
-            if rating > self.best_rating:
-                self.best_rating = rating
-                self.best_rating_reached_at = timezone.now()
+            self.update_level()
+            fields = ['score_sum', 'rounds_count', 'average_score', 'victories', 'defeats', 'draws', 'level']
+            fields += self.update_rating()
             if not full:
-                self.save()
+                self.save(update_fields=fields)
                 return self.rating
 
         finished_duel1_rounds = self.rounds.duel().finished()
         finished_duel2_rounds = self.guest_rounds.duel().finished()
-        self.duel_average_score = round(
-            (
-                (finished_duel1_rounds.aggregate(s=Sum['score1'])['s'] or 0) +
-                (finished_duel2_rounds.aggregate(s=Sum['score2'])['s'] or 0)
-            ) / (finished_duel1_rounds.count() + finished_duel2_rounds.count())
+        self.duel_score_sum = (
+            (finished_duel1_rounds.aggregate(s=Sum('score1'))['s'] or 0) +
+            (finished_duel2_rounds.aggregate(s=Sum('score2'))['s'] or 0)
         )
+        self.duel_rounds_count = finished_duel1_rounds.count() + finished_duel2_rounds.count()
+        self.duel_average_score = round(self.duel_score_sum / self.duel_rounds_count) if self.duel_rounds_count else 0
         self.duel_victories = finished_duel1_rounds.victories(side=1).count() +\
             finished_duel2_rounds.victories(side=2).count()
         self.duel_defeats = finished_duel1_rounds.defeats(side=1).count() +\
             finished_duel2_rounds.defeats(side=2).count()
         self.duel_draws = finished_duel1_rounds.draws().count() + finished_duel2_rounds.draws().count()
-        # TODO duel elo rating
-        self.save()
+        self.save(update_fields=fields + [
+            'duel_score_sum', 'duel_rounds_count', 'duel_average_score', 'duel_victories', 'duel_defeats',
+            'duel_draws'
+        ])
         return self.rating
 
+    @classmethod
+    def update_ratings(cls, chunk_size: int = 5000) -> int:
+        # update_rating and update_level for everybody, one chunk of players at a time
+        player_ids = list(cls.objects.order_by('id').values_list('id', flat=True))
+        return sum(
+            cls.update_ratings_chunk(player_ids[i:i + chunk_size]) for i in range(0, len(player_ids), chunk_size)
+        )
+
+    @classmethod
+    def update_ratings_chunk(cls, player_ids: list[int]) -> int:
+        # The players are locked in id order like in Round.finish, so a round finishing meanwhile is either
+        # counted here or recounts the rating after this chunk commits. The last ten rounds of the chunk come
+        # from one windowed query, and changed values are written by one UPDATE per field value like in Answer.bind
+        fields = ['rating', 'best_rating', 'best_rating_reached_at', 'level']
+        ids_by_value = {field: defaultdict(list) for field in fields}
+        changed_ratings = {}
+        now = timezone.now()
+        with transaction.atomic():
+            players = list(
+                cls.objects.select_for_update().filter(id__in=player_ids).order_by('id').only(
+                    'id', 'average_score', *fields
+                )
+            )
+            rounds = Round.objects.chatgpt().finished().filter(player1_id__in=player_ids).with_rating_points()
+            rounds = rounds.annotate(
+                row_number=Window(RowNumber(), partition_by=F('player1'), order_by=F('finished_at').desc())
+            ).filter(row_number__lte=10).values_list('player1_id', 'rating_points')
+            ratings = defaultdict(float)
+            for player_id, rating_points in rounds:
+                ratings[player_id] += rating_points
+            for player in players:
+                values = [getattr(player, field) for field in fields]
+                player.rating = round(ratings.get(player.id, 0))
+                if player.rating > player.best_rating:
+                    player.best_rating = player.rating
+                    player.best_rating_reached_at = now
+                player.update_level()
+                for field, value in zip(fields, values):
+                    if getattr(player, field) != value:
+                        ids_by_value[field][getattr(player, field)].append(player.id)
+                if player.rating != values[0]:
+                    changed_ratings[player.id] = player.rating
+            for field, ids_by_field_value in ids_by_value.items():
+                for value, ids in ids_by_field_value.items():
+                    cls.objects.filter(id__in=ids).update(**{field: value})
+        # Queryset updates skip save(), so the leaderboard is updated here
+        get_leaderboard().set_many(changed_ratings)
+        return len({player_id for values in ids_by_value.values() for ids in values.values() for player_id in ids})
+
+    @staticmethod
+    def get_elo_delta(rating: int, opponent_rating: int, score: float) -> int:
+        expected_score = 1 / (1 + 10 ** ((opponent_rating - rating) / 400))
+        return round(Config.duel_elo_k * (score - expected_score))
+
+    @classmethod
+    def replay_duel_ratings(cls, chunk_size: int = 5000) -> int:
+        # Rebuilds duel_rating by applying every finished duel in chronological order, as Round.finish did
+        rounds = Round.objects.duel().finished().order_by('finished_at', 'id').values_list(
+            'player1_id', 'player2_id', 'hits_mode', 'score1', 'score2', 'hits1', 'hits2'
+        )
+        ratings = defaultdict(lambda: Config.duel_initial_rating)
+        for player1_id, player2_id, hits_mode, score1, score2, hits1, hits2 in rounds.iterator(chunk_size=chunk_size):
+            round_ = Round(hits_mode=hits_mode, score1=score1, score2=score2, hits1=hits1, hits2=hits2)
+            ratings[player1_id], ratings[player2_id] = Round.get_duel_ratings(
+                ratings[player1_id],
+                ratings[player2_id],
+                round_.get_result(1)
+            )
+        ids_by_rating = defaultdict(list)
+        players = cls.objects.values_list('id', 'duel_rating')
+        for player_id, duel_rating in players.iterator(chunk_size=chunk_size):
+            if ratings[player_id] != duel_rating:
+                ids_by_rating[ratings[player_id]].append(player_id)
+        with transaction.atomic():
+            for duel_rating, ids in ids_by_rating.items():
+                for i in range(0, len(ids), chunk_size):
+                    cls.objects.filter(id__in=ids[i:i + chunk_size]).update(duel_rating=duel_rating)
+        # Queryset updates skip save(), so the leaderboard is rebuilt here
+        get_leaderboard('duel_rating').replace(
+            dict(cls.objects.filter(duel_rounds_count__gt=0).values_list('id', 'duel_rating'))
+        )
+        return sum(len(ids) for ids in ids_by_rating.values())
+
+    def get_rating(self) -> float:
+        rounds = self.rounds.chatgpt().last_finished(10).with_rating_points()
+        return rounds.aggregate(rating=Sum('rating_points'))['rating'] or 0
+
+    @staticmethod
+    def get_level(average_score: int, level: int) -> int:
+        for i, value in enumerate(Config.topic_levels):
+            if average_score < value:
+                return i
+        return level
+
+    def update_level(self) -> None:
+        self.level = self.get_level(self.average_score, self.level)
+
+    def update_rating(self) -> list[str]:
+        self.rating = round(self.get_rating())
+        if self.rating <= self.best_rating:
+            return ['rating']
+        self.best_rating = self.rating
+        self.best_rating_reached_at = timezone.now()
+        return ['rating', 'best_rating', 'best_rating_reached_at']
+
     @property
     def displayed_name(self) -> str:
         displayed_name = self.name
@@ -443,7 +782,11 @@ class Player(models.Model):
 
     @property
     def position(self) -> int:
-        return Player.objects.filter(rating__gt=self.rating).count() + 1
+        return get_leaderboard().rank(self.rating)
+
+    @property
+    def duel_position(self) -> int:
+        return get_leaderboard('duel_rating').rank(self.duel_rating)
 
 
 class RoundQuerySet(models.QuerySet):
@@ -485,6 +828,30 @@ class RoundQuerySet(models.QuerySet):
     def points_mode(self):
         return self.filter(hits_mode=False)
 
+    def with_rating_points(self):
+        # A round's share of player1's rating: the score and outcome bonus, fading by fading_rating_coef
+        # for every day since the round; days are counted in UTC like finished_at.date() does
+        midnight = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        aging_coef = Case(
+            *[
+                When(finished_at__gte=midnight - timezone.timedelta(days=days), then=Value(
+                    1 - days*Config.fading_rating_coef
+                ))
+                for days in range(math.ceil(1 / Config.fading_rating_coef))
+            ],
+            default=Value(0.0),
+            output_field=FloatField()
+        )
+        bonus = Case(
+            When(score1__gt=F('score2'), then=Value(Config.victory_rating_bonus)),
+            When(score1=F('score2'), then=Value(Config.draw_rating_bonus)),
+            default=Value(0)
+        )
+        return self.annotate(rating_points=ExpressionWrapper(
+            (F('score1') + bonus) * aging_coef,
+            output_field=FloatField()
+        ))
+
     def victories(self, side: int = 1):
         if side == 1:
             points_mode_qs = self.filter(score1__gt=F('score2'), hits_mode=False)
@@ -520,8 +887,7 @@ class Round(models.Model):
     hits2 = models.PositiveSmallIntegerField('Хиты 2', default=0)
     started_at = models.DateTimeField('Начало', auto_now_add=True)
     finished_at = models.DateTimeField('Окончание', null=True, blank=True)
-    bot_answers = models.TextField('Возможные ответы бота', default='{}')
-    declined_answers = models.TextField('Отклонённые ответы', default='[]')
+    used_topic_entities = models.TextField('Использованные сущности', blank=True)
     feedback1 = models.TextField('Обратная связь 1')
     feedback2 = models.TextField('Обратная связь 2')
     checked = models.BooleanField('Проверен', db_index=True, default=False)
@@ -544,16 +910,38 @@ class Round(models.Model):
             outcome = 'vs'
         return f'{self.topic} — {self.player1} {outcome} {player2}'
 
+    # Columns an answer can change; they are written once by save_answer_changes
+    answer_fields = ['attempt', 'used_topic_entities']
+
     @classmethod
     def set_checked(cls, ids: list[int]):
         cls.objects.filter(id__in=ids).update(checked=True)
         Answer.discard_for_rounds(ids)
 
+    @classmethod
+    def lock(cls, round_id: int) -> 'Round':
+        # Answers of one round are serialized by the row lock; call inside a transaction.
+        # Only the round row is locked, not the topic and player joined to it
+        round_ = get_object_or_404(
+            cls.objects.select_for_update(of=('self',)).select_related('topic', 'player1'),
+            id=round_id
+        )
+        round_.locked_values = {field: getattr(round_, field) for field in cls.answer_fields}
+        return round_
+
+    def save_answer_changes(self) -> None:
+        changes = {
+            field: getattr(self, field) for field in self.answer_fields
+            if getattr(self, field) != self.locked_values[field]
+        }
+        if 'attempt' in changes:
+            changes['attempt'] = F('attempt') + (self.attempt - self.locked_values['attempt'])
+        if changes:
+            Round.objects.filter(id=self.id).update(**changes)
+            self.locked_values = {field: getattr(self, field) for field in self.answer_fields}
+
     def add_declined_answer(self, text: str, entity_title: str) -> None:
-        declined_answers = json.loads(self.declined_answers)
-        declined_answers.append((text, entity_title))
-        self.declined_answers = json.dumps(declined_answers, ensure_ascii=False)
-        self.save()
+        DeclinedAnswer.objects.create(round=self, text=text, entity_title=entity_title)
 
     def add_feedback(self, feedback: str, player: int = 1) -> None:
         setattr(self, f'feedback{player}', feedback)
@@ -574,39 +962,91 @@ class Round(models.Model):
         self.score2 = 0 if abort_side == 2 else score2
         self.hits1 = 0 if abort_side == 2 else hits1
         self.hits2 = 0 if abort_side == 2 else hits2
-        self.save()
-        self.topic.update_statistics()
-        rating1 = self.player1.update_statistics()
-        position1 = self.player1.position
-        rating2, position2 = 0, 0
-        if self.duel:
-            rating2 = self.player2.update_statistics()
-            position2 = self.player2.position
-        return rating1, position1, rating2, position2
+        with transaction.atomic():
+            # The counters below are increments, so only the call that actually finishes the round applies them:
+            # a concurrent finish of the same round updates no rows here
+            finish_fields = ['finished_at', 'score1', 'score2', 'hits1', 'hits2']
+            if not Round.objects.filter(id=self.id, finished_at__isnull=True).update(
+                **{field: getattr(self, field) for field in finish_fields}
+            ):
+                return 0, 0, 0, 0
+            self.topic.add_round_score(self.score1, self.hits_mode)
+            if self.duel:
+                # Both rows are locked in id order, so duels of the same pair finishing at once cannot deadlock
+                players = Player.objects.select_for_update().filter(id__in=[self.player1_id, self.player2_id])
+                list(players.order_by('id'))
+                rating1 = self.player1.add_round(self, side=1)
+                rating2 = self.player2.add_round(self, side=2)
+                self.update_duel_ratings()
+            else:
+                rating1, rating2 = self.player1.add_round(self, side=1), 0
+        # Positions are read after the commit has updated the leaderboards. The duel ratings are left on
+        # the player instances
+        return rating1, self.player1.position, rating2, self.player2.position if self.duel else 0
+
+    @staticmethod
+    def get_duel_ratings(rating1: int, rating2: int, result: str) -> tuple[int, int]:
+        delta = Player.get_elo_delta(rating1, rating2, {'victories': 1, 'draws': 0.5, 'defeats': 0}[result])
+        return max(0, rating1 + delta), max(0, rating2 - delta)
+
+    def update_duel_ratings(self) -> None:
+        players = [self.player1, self.player2]
+        for player in players:
+            player.refresh_from_db(fields=['duel_rating'])
+        self.player1.duel_rating, self.player2.duel_rating = self.get_duel_ratings(
+            self.player1.duel_rating,
+            self.player2.duel_rating,
+            self.get_result(1)
+        )
+        for player in players:
+            player.save(update_fields=['duel_rating'])
 
     def get_bot_answer(self) -> tuple[str, TopicEntity]:
-        bot_answers_slice = list(json.loads(self.bot_answers).items())[0:3]
-        topic_entity_id, bot_answer = choice(bot_answers_slice)
-        topic_entity = TopicEntity.objects.get(id=topic_entity_id)
+        strength = Config.bot_strengths[min(self.player1.level, len(Config.bot_strengths) - 1)]
+        sampler = get_bot_sampler(self.topic, Config.bot_sampler_ttl)
+        bot_answer, topic_entity_id = sampler.choose(strength, self.get_used_topic_entities())
+        # Built from the sampler, whose positions are as fresh as the topic's positions_version
+        entity_id, title, position = sampler.topic_entities[topic_entity_id]
+        topic_entity = TopicEntity(
+            id=topic_entity_id,
+            topic=self.topic,
+            entity=Entity(id=entity_id, title=title),
+            position=position
+        )
         Answer.get_or_create(round=self, topic_entity=topic_entity, text=bot_answer, player=2)
         return bot_answer, topic_entity
 
-    def shorten_bot_answers(self, topic_entity_id: int) -> None:
-        bot_answers = json.loads(self.bot_answers)
-        if str(topic_entity_id) in bot_answers:
-            del bot_answers[str(topic_entity_id)]
-        if not bot_answers:
-            used_ids = [answer.topic_entity.id for answer in self.answers.bound()]
-            topic_entities = self.topic.topic_entities.exclude(id__in=used_ids).filter(position__lt=11)
-            bot_answers = {te.id: te.entity.title for te in topic_entities}
-        self.update_bot_answers(json.dumps(bot_answers, ensure_ascii=False))
-
-    def update_bot_answers(self, bot_answers: str = '') -> None:
-        if bot_answers:
-            self.bot_answers = bot_answers
-        else:
-            self.bot_answers = self.topic.bot_answers
-        self.save()
+    def add_to_played_topics(self) -> None:
+        # Appended in SQL, so rounds started at once by the same player do not overwrite each other
+        topic_id = str(self.topic_id)
+        player_ids = [self.player1_id, self.player2_id] if self.duel else [self.player1_id]
+        Player.objects.filter(id__in=player_ids).update(
+            played_topics=Case(
+                When(played_topics='', then=Value(topic_id)),
+                default=Concat('played_topics', Value(f' {topic_id}')),
+                output_field=models.TextField()
+            )
+        )
+        # The prepared offers may include this topic now
+        Player.refill_topic_offers(player_ids)
+
+    def get_used_topic_entities(self) -> set[int]:
+        return {int(topic_entity_id) for topic_entity_id in self.used_topic_entities.split()}
+
+    def use_topic_entity(self, topic_entity_id: int) -> None:
+        if topic_entity_id not in self.get_used_topic_entities():
+            self.used_topic_entities = f'{self.used_topic_entities} {topic_entity_id}'.strip()
+
+    def get_result(self, side: int = 1) -> str:
+        # 'victories', 'defeats' or 'draws' for the side, as RoundQuerySet counts them
+        results = [(self.hits1, self.score1), (self.hits2, self.score2)] if self.hits_mode else \
+            [(self.score1,), (self.score2,)]
+        own, other = results if side == 1 else results[::-1]
+        if own > other:
+            return 'victories'
+        if own < other:
+            return 'defeats'
+        return 'draws'
 
     @property
     def outcome(self, hits_mode: bool = False) -> str:
@@ -695,6 +1135,33 @@ class Answer(models.Model):
     def discard_for_rounds(cls, ids: list[int]):
         cls.objects.filter(round_id__in=ids).unbound().update(discarded=True)
 
+    @classmethod
+    def bind(cls, bindings: list[tuple['Answer', TopicEntity]]) -> int:
+        round_ids = {answer.round_id for answer, _ in bindings}
+        bound = set(cls.objects.filter(round_id__in=round_ids).bound().values_list('round_id', 'topic_entity_id'))
+        duel_round_ids = set(Round.objects.filter(id__in=round_ids, duel=True).values_list('id', flat=True))
+        answers = []
+        counts = defaultdict(int)
+        for answer, topic_entity in bindings:
+            if (answer.round_id, topic_entity.id) in bound:
+                continue
+            bound.add((answer.round_id, topic_entity.id))
+            answer.topic_entity = topic_entity
+            answers.append(answer)
+            # Counted like the hits, so reconcile_answers_counts agrees with it
+            if answer.player == 1 or answer.round_id in duel_round_ids:
+                counts[topic_entity] += 1
+        ids_by_increment = defaultdict(list)
+        for topic_entity, increment in counts.items():
+            ids_by_increment[increment].append(topic_entity.id)
+        with transaction.atomic():
+            cls.objects.bulk_update(answers, ['topic_entity'])
+            for increment, ids in ids_by_increment.items():
+                TopicEntity.objects.filter(id__in=ids).update(answers_count=F('answers_count') + increment)
+            for topic in Topic.objects.filter(id__in={topic_entity.topic_id for topic_entity in counts}):
+                topic.update_entities_positions()
+        return len(answers)
+
     @classmethod
     def get_or_create(
             cls,
@@ -703,22 +1170,25 @@ class Answer(models.Model):
             text: str = '',
             player: int = 1
     ) -> bool:
+        # Expects a round from Round.lock: its changes are kept on the instance until save_answer_changes
         if topic_entity:
-            _, created = cls.objects.get_or_create(
-                round=round,
-                topic_entity=topic_entity,
-                defaults={'player': player, 'text': text, 'position': topic_entity.position}
-            )
-            round.shorten_bot_answers(topic_entity.id)
-            if player == 1 or round.duel:
-                topic_entity.increment_answers_count()
+            created = not cls.objects.filter(round=round, topic_entity=topic_entity).exists()
+            if created:
+                cls.objects.create(
+                    round=round,
+                    topic_entity=topic_entity,
+                    player=player,
+                    text=text,
+                    position=topic_entity.position
+                )
+            round.use_topic_entity(topic_entity.id)
+            if created and (player == 1 or round.duel):
+                topic_entity.count_answer()
         else:
-            _, created = cls.objects.get_or_create(
-                round=round,
-                text=text
-            )
+            created = not cls.objects.filter(round=round, text=text).exists()
+            if created:
+                cls.objects.create(round=round, text=text)
         round.attempt += 1
-        round.save()
         return created
 
     def assign_topic_entity(self, topic_entity_id: int | None = None, topic_entity: TopicEntity | None = None) -> None:
@@ -727,5 +1197,36 @@ class Answer(models.Model):
         if topic_entity:
             self.topic_entity = topic_entity
             self.save()
-            topic_entity.increment_answers_count()
-            self.round.topic.update_entities_positions()
+            # Counted like the hits, so reconcile_answers_counts agrees with it
+            if self.player == 1 or self.round.duel:
+                topic_entity.count_answer()
+
+
+class DeclinedAnswer(models.Model):
+    round = models.ForeignKey(Round, verbose_name='Раунд', on_delete=models.CASCADE, related_name='declined_answers')
+    text = models.TextField('Ответ')
+    entity_title = models.CharField('Сущность или причина', max_length=100)
+    sent_at = models.DateTimeField('Отправлен', auto_now_add=True)
+
+    class Meta:
+        ordering = ['id']
+
+    def __str__(self) -> str:
+        return f'{self.text} • {self.entity_title}'
+
+
+class Job(models.Model):
+    name = models.CharField('Задача', max_length=100)
+    key = models.CharField('Ключ', max_length=100, db_index=True, blank=True)
+    args = models.TextField('Аргументы', default='[]')
+    created_at = models.DateTimeField('Создана', auto_now_add=True)
+    run_after = models.DateTimeField('Запуск не раньше', db_index=True, default=timezone.now)
+    attempts = models.PositiveSmallIntegerField('Попытки', default=0)
+    failed = models.BooleanField('Не выполнена', db_index=True, default=False)
+    error = models.TextField('Ошибка', blank=True)
+
+    class Meta:
+        ordering = ['run_after', 'id']
+
+    def __str__(self) -> str:
+        return f'{self.name} {self.args}'
@@ -0,0 +1,83 @@
+import json
+import threading
+import time
+from collections import deque
+
+import redis
+from django.conf import settings
+
+
+class LocalTopicOffers:
+    # In-process fallback for tests and development: prepared offers of this process only
+    shared = False
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.version = 0
+        self.queues: dict[int, tuple[float, deque]] = {}
+        self.lock = threading.Lock()
+
+    def get_version(self) -> int:
+        return self.version
+
+    def bump_version(self) -> None:
+        with self.lock:
+            self.version += 1
+            self.queues.clear()
+
+    def replace(self, player_id: int, version: int, offers: list[list[tuple[int, str]]]) -> None:
+        with self.lock:
+            if version == self.version:
+                self.queues[player_id] = (time.monotonic(), deque(offers))
+
+    def pop(self, player_id: int) -> list[tuple[int, str]] | None:
+        with self.lock:
+            filled_at, queue = self.queues.get(player_id, (0, deque()))
+            if not queue or time.monotonic() - filled_at >= self.ttl:
+                self.queues.pop(player_id, None)
+                return None
+            return queue.popleft()
+
+
+class RedisTopicOffers:
+    # One list of offers per player under the current topics version; older versions just expire
+    shared = True
+
+    def __init__(self, url: str, ttl: float, key: str = 'topic-offers'):
+        self.redis = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.key = key
+
+    def get_version(self) -> int:
+        return int(self.redis.get(f'{self.key}:version') or 0)
+
+    def bump_version(self) -> None:
+        self.redis.incr(f'{self.key}:version')
+
+    def replace(self, player_id: int, version: int, offers: list[list[tuple[int, str]]]) -> None:
+        queue_key = f'{self.key}:{version}:{player_id}'
+        pipeline = self.redis.pipeline(transaction=True)
+        pipeline.delete(queue_key)
+        if offers:
+            pipeline.rpush(queue_key, *(json.dumps(offer, ensure_ascii=False) for offer in offers))
+            pipeline.expire(queue_key, int(self.ttl))
+        pipeline.execute()
+
+    def pop(self, player_id: int) -> list[tuple[int, str]] | None:
+        offer = self.redis.lpop(f'{self.key}:{self.get_version()}:{player_id}')
+        return [tuple(topic) for topic in json.loads(offer)] if offer else None
+
+
+_topic_offers: LocalTopicOffers | RedisTopicOffers | None = None
+
+
+def get_topic_offers(ttl: float) -> LocalTopicOffers | RedisTopicOffers:
+    global _topic_offers
+    if _topic_offers is None:
+        _topic_offers = RedisTopicOffers(settings.REDIS_URL, ttl) if settings.REDIS_URL else LocalTopicOffers(ttl)
+    return _topic_offers
+
+
+def clear_topic_offers() -> None:
+    global _topic_offers
+    _topic_offers = None
@@ -0,0 +1,151 @@
+import json
+import math
+import random
+import time
+from bisect import bisect_left, bisect_right
+
+from django.apps import apps
+
+
+class AliasTable:
+    # Vose's alias method: O(n) to build, O(1) per weighted draw
+    def __init__(self, weights: list[float]):
+        count = len(weights)
+        total = sum(weights)
+        self.probabilities = [weight * count / total for weight in weights]
+        self.aliases = list(range(count))
+        small = [i for i, probability in enumerate(self.probabilities) if probability < 1]
+        large = [i for i, probability in enumerate(self.probabilities) if probability >= 1]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.aliases[less] = more
+            self.probabilities[more] += self.probabilities[less] - 1
+            (small if self.probabilities[more] < 1 else large).append(more)
+        for i in small + large:
+            self.probabilities[i] = 1
+
+    def draw(self, rng: random.Random) -> int:
+        i = rng.randrange(len(self.probabilities))
+        return i if rng.random() < self.probabilities[i] else self.aliases[i]
+
+
+class BotSampler:
+    # Candidate answers of one topic: ChatGPT's own answers first, the ten most popular entities after them.
+    # Weights grow with the answer counts, raised to a strength that depends on the player's level.
+    # Candidates are (text, topic entity id, answers count); the chosen topic entity is built from
+    # topic_entities: topic entity id -> (entity id, title, position)
+    max_rejections = 20
+
+    def __init__(
+            self,
+            stamp: tuple,
+            tiers: list[list[tuple[str, int, int]]],
+            topic_entities: dict[int, tuple[int, str, int]] | None = None
+    ):
+        self.stamp = stamp
+        self.built_at = time.monotonic()
+        self.tiers = [tier for tier in tiers if tier]
+        self.topic_entities = topic_entities or {}
+        self.tables: dict[tuple[int, float], AliasTable] = {}
+
+    def weights(self, tier: list[tuple[str, int, int]], strength: float) -> list[float]:
+        return [(answers_count + 1) ** strength for _, _, answers_count in tier]
+
+    def choose(self, strength: float, excluded_ids: set[int], rng: random.Random = random) -> tuple[str, int]:
+        for i, tier in enumerate(self.tiers):
+            if (i, strength) not in self.tables:
+                self.tables[i, strength] = AliasTable(self.weights(tier, strength))
+            table = self.tables[i, strength]
+            # Rejection keeps draws O(1) while the round has used few candidates
+            for _ in range(self.max_rejections):
+                text, topic_entity_id, _ = tier[table.draw(rng)]
+                if topic_entity_id not in excluded_ids:
+                    return text, topic_entity_id
+            remaining = [candidate for candidate in tier if candidate[1] not in excluded_ids]
+            if remaining:
+                text, topic_entity_id, _ = rng.choices(remaining, self.weights(remaining, strength))[0]
+                return text, topic_entity_id
+        raise IndexError('No bot answers left')
+
+
+# Long-lived per-worker cache: topic id -> sampler, rebuilt when the topic, its positions or answer counts
+# change or the sampler gets old
+_bot_samplers: dict[int, BotSampler] = {}
+
+
+def get_bot_sampler(topic, ttl: float) -> BotSampler:
+    stamp = (topic.matches_version, topic.positions_version, topic.bot_answers)
+    sampler = _bot_samplers.get(topic.id)
+    if sampler is not None and sampler.stamp == stamp and time.monotonic() - sampler.built_at < ttl:
+        return sampler
+    rows = topic.topic_entities.values_list('id', 'entity_id', 'entity__title', 'position', 'answers_count')
+    answers_counts = {}
+    topic_entities = {}
+    for topic_entity_id, entity_id, title, position, answers_count in rows:
+        answers_counts[topic_entity_id] = answers_count
+        topic_entities[topic_entity_id] = (entity_id, title, position)
+    texts = {int(topic_entity_id): text for topic_entity_id, text in json.loads(topic.bot_answers).items()}
+    chatgpt_tier = [(text, te_id, answers_counts[te_id]) for te_id, text in texts.items() if te_id in answers_counts]
+    popular_tier = [
+        (title, te_id, answers_counts[te_id])
+        for te_id, (_, title, position) in topic_entities.items() if position <= 10
+    ]
+    sampler = BotSampler(stamp, [chatgpt_tier, popular_tier], topic_entities)
+    _bot_samplers[topic.id] = sampler
+    return sampler
+
+
+def clear_bot_samplers() -> None:
+    _bot_samplers.clear()
+
+
+class TopicPool:
+    # Ids of all topics sorted by average score, so the topics of a level range are one contiguous slice
+    max_rejections = 20
+
+    def __init__(self, topics: list[tuple[float, int]]):
+        self.built_at = time.monotonic()
+        self.topics = sorted(topics)
+        self.scores = [average_score for average_score, _ in self.topics]
+
+    def sample(
+        self,
+        count: int,
+        excluded_ids: set[int],
+        min_score: float = -math.inf,
+        max_score: float = math.inf,
+        rng: random.Random = random
+    ) -> list[int]:
+        start, stop = bisect_left(self.scores, min_score), bisect_right(self.scores, max_score)
+        if start >= stop:
+            return []
+        chosen = []
+        # Rejection keeps draws O(1) while the player has played few of the topics
+        for _ in range(count * self.max_rejections):
+            topic_id = self.topics[rng.randrange(start, stop)][1]
+            if topic_id not in excluded_ids and topic_id not in chosen:
+                chosen.append(topic_id)
+                if len(chosen) == count:
+                    return chosen
+        remaining = [
+            topic_id for _, topic_id in self.topics[start:stop]
+            if topic_id not in excluded_ids and topic_id not in chosen
+        ]
+        return chosen + rng.sample(remaining, min(count - len(chosen), len(remaining)))
+
+
+# Per-worker pool of all topics, rebuilt when it gets old
+_topic_pool: TopicPool | None = None
+
+
+def get_topic_pool(ttl: float) -> TopicPool:
+    global _topic_pool
+    if _topic_pool is None or time.monotonic() - _topic_pool.built_at >= ttl:
+        Topic = apps.get_model('game', 'Topic')
+        _topic_pool = TopicPool(list(Topic.objects.values_list('average_score', 'id')))
+    return _topic_pool
+
+
+def clear_topic_pool() -> None:
+    global _topic_pool
+    _topic_pool = None
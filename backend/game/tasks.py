@@ -0,0 +1,23 @@
+from .jobs import enqueue, task
+from .models import Config, Player, Topic, TopicEntity
+
+
+@task
+def flush_answer_counts() -> None:
+    if TopicEntity.flush_answer_counts():
+        # Flushes again while answers keep coming, so the last ones do not wait for the next hit
+        enqueue('flush_answer_counts', key='flush-answer-counts', delay=Config.answer_counts_flush_interval)
+
+
+@task
+def fill_topic_offers(player_id: int) -> None:
+    player = Player.objects.filter(id=player_id).first()
+    if player:
+        player.fill_topic_offers()
+
+
+@task
+def rematch_unbound_answers(topic_id: int) -> None:
+    topic = Topic.objects.filter(id=topic_id).first()
+    if topic:
+        topic.rematch_unbound_answers()
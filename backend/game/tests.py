@@ -1,3 +1,992 @@
-from django.test import TestCase
+import contextlib
+import io
+import json
+import random
+from unittest import mock
 
-# Create your tests here.
+import jellyfish
+from django.core.management import call_command
+from django.core.signals import request_finished
+from django.db import DatabaseError, connection, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.db.models import F
+from django.shortcuts import get_object_or_404
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from . import tasks  # noqa: F401
+from .counters import clear_answer_counts, get_answer_counts
+from .jobs import MAX_ATTEMPTS, RETRY_DELAY, enqueue, run_next
+from .leaderboard import LocalLeaderboard, RedisLeaderboard, clear_leaderboard
+from .matching import (
+    Normalizer, PatternAutomaton, TopicIndex, clear_topic_indexes, get_topic_index, negative_cache_stats,
+    simplify_text
+)
+from .models import Answer, Config, Entity, Job, Player, Round, Topic, TopicEntity
+from .offers import clear_topic_offers, get_topic_offers
+from .sampling import AliasTable, BotSampler, TopicPool, clear_bot_samplers, clear_topic_pool, get_bot_sampler
+
+
+def create_player(number: int = 1) -> Player:
+    return Player.objects.create(telegram_id=number, telegram_username='', name=f'Игрок {number}', assigned_topics='')
+
+
+def create_topic(title: str, patterns: dict[str, str]) -> Topic:
+    # Topic with one entity per title, positioned in the given order and with its matches gathered
+    topic = Topic.objects.create(title=title)
+    for position, (entity_title, pattern) in enumerate(patterns.items(), start=1):
+        entity = Entity.objects.create(title=entity_title, pattern=pattern)
+        entity.compile_pattern()
+        TopicEntity.objects.create(topic=topic, entity=entity, position=position)
+    topic.gather_matches()
+    topic.refresh_from_db()
+    return topic
+
+
+class TopicIndexTest(SimpleTestCase):
+
+    @staticmethod
+    def scan(matches: dict[str, list[int]], text: str) -> set[int]:
+        matching_ids = set()
+        for match in matches:
+            if jellyfish.damerau_levenshtein_distance(match, text) <= 1:
+                matching_ids.update(matches[match])
+        return matching_ids
+
+    def test_lookup_similar_equals_linear_scan(self):
+        rng = random.Random(0)
+        alphabet = 'абвгдеклмн12'
+        matches = {}
+        for entity_id in range(300):
+            key = ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 7)))
+            matches.setdefault(key, []).append(entity_id)
+        index = TopicIndex((), matches, Normalizer())
+        texts = set()
+        for key in matches:
+            for _ in range(5):
+                text = list(key)
+                position = rng.randint(0, len(text))
+                operation = rng.choice(['insert', 'delete', 'replace', 'transpose', 'double'])
+                if operation == 'insert':
+                    text.insert(position, rng.choice(alphabet))
+                elif operation == 'delete' and position < len(text):
+                    del text[position]
+                elif operation == 'replace' and position < len(text):
+                    text[position] = rng.choice(alphabet)
+                elif operation == 'transpose' and position < len(text) - 1:
+                    text[position], text[position + 1] = text[position + 1], text[position]
+                elif operation == 'double':
+                    text = [rng.choice(alphabet) for _ in range(rng.randint(0, 8))]
+                texts.add(''.join(text))
+        for text in texts:
+            with self.subTest(text=text):
+                self.assertEqual(set(index.lookup_similar(text)), self.scan(matches, text))
+
+    def test_update_equals_fresh_build(self):
+        rng = random.Random(0)
+        alphabet = 'абвгд12'
+        patterns = ['(аб) вг', '*а(б) в(г) д', 'аа(бв) 2(1)']
+        matches = set()
+        for _ in range(200):
+            key = ''.join(rng.choice(alphabet) for _ in range(rng.randint(1, 5)))
+            matches.add((key, rng.randint(1, 60), False))
+        matches.update((rng.choice(patterns), entity_id, True) for entity_id in range(61, 64))
+        index = self.build_index((), matches)
+        for stamp in range(1, 6):
+            removed = set(rng.sample(sorted(matches), 30))
+            added = {
+                (''.join(rng.choice(alphabet) for _ in range(rng.randint(1, 5))), rng.randint(1, 60), False)
+                for _ in range(30)
+            } - matches
+            added.add((rng.choice(patterns), 60 + stamp, True))
+            added -= {match for match in matches if match[1] == 60 + stamp}
+            matches = matches - removed | added
+            index.update(removed, added, (stamp,))
+            fresh_index = self.build_index((stamp,), matches)
+            self.assertEqual(index.stamp, fresh_index.stamp)
+            for _ in range(300):
+                text = ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 6)))
+                with self.subTest(stamp=stamp, text=text):
+                    self.assertEqual(sorted(index.lookup(text)), sorted(fresh_index.lookup(text)))
+
+    @staticmethod
+    def build_index(stamp: tuple, matches: set[tuple[str, int, bool]]) -> TopicIndex:
+        keys = {}
+        patterns = {}
+        for key, entity_id, automaton in matches:
+            if automaton:
+                patterns[entity_id] = key
+            else:
+                keys.setdefault(key, []).append(entity_id)
+        return TopicIndex(stamp, keys, Normalizer(), patterns)
+
+
+class TopicIndexCacheTest(TestCase):
+
+    def setUp(self):
+        clear_topic_indexes()
+        self.topic = create_topic('Реки', {'Волга': 'волга', 'Ока': 'ока'})
+
+    def test_index_is_reused_and_patched(self):
+        index = get_topic_index(self.topic)
+        with self.assertNumQueries(0):
+            self.assertIs(get_topic_index(self.topic), index)
+        entity = Entity.objects.create(title='Дон', pattern='дон')
+        TopicEntity.objects.create(topic=self.topic, entity=entity, position=3)
+        with self.captureOnCommitCallbacks(execute=True):
+            entity.compile_pattern()
+        self.topic.refresh_from_db()
+        # The new entity's matches are added to this worker's index in place
+        with self.assertNumQueries(0):
+            self.assertIs(get_topic_index(self.topic), index)
+        self.assertEqual(index.lookup('Дон'), [entity.id])
+
+    def test_exact_key_resolves_without_index(self):
+        clear_topic_indexes()
+        with self.assertNumQueries(1):
+            topic_entities = self.topic.get_matching_entities('Волга')
+        self.assertEqual([topic_entity.entity.title for topic_entity in topic_entities], ['Волга'])
+        self.assertIsNone(get_topic_index(self.topic, build=False))
+
+    def test_automata_are_kept_in_index(self):
+        entity = Entity.objects.create(title='Москва', pattern='москва(река)')
+        TopicEntity.objects.create(topic=self.topic, entity=entity, position=3)
+        with mock.patch.object(Config, 'max_pattern_spellings', 1), self.captureOnCommitCallbacks(execute=True):
+            entity.compile_pattern()
+        self.assertTrue(entity.uses_automaton)
+        self.topic.refresh_from_db()
+        clear_topic_indexes()
+        self.assertEqual(self.topic.get_matching_entities('Москвак')[0].entity, entity)
+        self.assertIsNotNone(get_topic_index(self.topic, build=False))
+        for text, title in [('Москва', 'Москва'), ('Волга', 'Волга'), ('Москвар', 'Москва')]:
+            with self.assertNumQueries(1):
+                topic_entities = self.topic.get_matching_entities(text)
+            self.assertEqual([topic_entity.entity.title for topic_entity in topic_entities], [title])
+
+    def test_index_is_rebuilt_on_normalizer_change(self):
+        index = get_topic_index(self.topic)
+        self.topic.exclusions = 'река'
+        self.topic.save()
+        rebuilt_index = get_topic_index(self.topic)
+        self.assertIsNot(rebuilt_index, index)
+        self.assertEqual(rebuilt_index.lookup('река Ока'), [self.topic.entities.get(title='Ока').id])
+        self.assertEqual(index.lookup('река Ока'), [])
+
+
+class NegativeCacheTest(TestCase):
+
+    def setUp(self):
+        clear_topic_indexes()
+        negative_cache_stats.clear()
+        self.topic = create_topic('Реки', {'Волга': 'волга', 'Ока': 'ока'})
+
+    def test_misses_are_cached_until_matches_change(self):
+        self.assertIsNone(self.topic.get_matching_entities('Енисей'))
+        with self.assertNumQueries(0):
+            self.assertIsNone(self.topic.get_matching_entities('енисей'))
+        stats = self.client.get('/api/game/matcher-stats').json()
+        self.assertEqual(
+            stats,
+            {'hits': 1, 'misses': 1, 'hit_rate': 0.5, 'evictions': 0, 'invalidations': 0, 'topics': 1, 'texts': 1}
+        )
+        entity = Entity.objects.create(title='Енисей', pattern='енисей')
+        TopicEntity.objects.create(topic=self.topic, entity=entity, position=3)
+        with self.captureOnCommitCallbacks(execute=True):
+            entity.compile_pattern()
+        self.topic.refresh_from_db()
+        self.assertEqual(self.topic.get_matching_entities('Енисей')[0].entity, entity)
+        stats = self.client.get('/api/game/matcher-stats').json()
+        self.assertEqual((stats['misses'], stats['invalidations'], stats['texts']), (2, 1, 0))
+
+
+class TopicMatchMigrationTest(TransactionTestCase):
+
+    def migrate(self, target: tuple[str, str]):
+        executor = MigrationExecutor(connection)
+        executor.migrate([target])
+        return executor.loader.project_state(target).apps
+
+    def tearDown(self):
+        self.migrate(MigrationExecutor(connection).loader.graph.leaf_nodes('game')[0])
+
+    def test_topic_matches_are_copied_to_rows(self):
+        apps = self.migrate(('game', '0037_topic_matches_version'))
+        Entity = apps.get_model('game', 'Entity')
+        volga = Entity.objects.create(title='Волга', pattern='(река) волга', matches='волга рекаволга')
+        oka = Entity.objects.create(title='Ока', pattern='ока', matches='ока')
+        matches = {'волга': [volga.id], 'рекаволга': [volga.id, volga.id], 'ока': [oka.id, oka.id + 1]}
+        apps.get_model('game', 'Topic').objects.create(title='Реки', matches=json.dumps(matches))
+        apps = self.migrate(('game', '0038_topicmatch'))
+        self.assertEqual(
+            set(apps.get_model('game', 'TopicMatch').objects.values_list('topic__title', 'key', 'entity_id')),
+            {('Реки', 'волга', volga.id), ('Реки', 'рекаволга', volga.id), ('Реки', 'ока', oka.id)}
+        )
+
+
+class NormalizerTest(SimpleTestCase):
+
+    def test_simplify_equals_simplify_text(self):
+        rng = random.Random(0)
+        alphabet = 'aAixX+#- .,!ЭэЁёЙйЕеОоооннн112²٣İßΣ\n\t'
+        odd_words = [(), ('река',), ('о', 'не'), ('на', 'н', 'аа')]
+        texts = ['', 'Река Волга', 'C++', 'C#', 'Рееееека  Ээээ', 'xxii', 'İstanbul', 'ΣΑΣ', 'нана', 'ннааа']
+        texts += [''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 20))) for _ in range(2000)]
+        for words in odd_words:
+            for extra_allowed_symbols in ['', '+#', ' ']:
+                normalizer = Normalizer(words, extra_allowed_symbols)
+                for text in texts:
+                    with self.subTest(text=text, odd_words=words, extra_allowed_symbols=extra_allowed_symbols):
+                        self.assertEqual(
+                            normalizer.simplify(text),
+                            simplify_text(text, odd_words=list(words), extra_allowed_symbols=extra_allowed_symbols)
+                        )
+
+
+class PatternAutomatonTest(SimpleTestCase):
+
+    def test_spellings(self):
+        patterns = {
+            '(река) волга': 'аволга еволга кволга рволга',
+            'иоганн себастьян бах = 3 13 23': 'бах иоганбах иогансебастьянбах себастьянбах',
+            'анна мария(я) / 3и': '3 iii анамария анамария трети',
+        }
+        for pattern, matches in patterns.items():
+            with self.subTest(pattern=pattern):
+                self.assertEqual(' '.join(PatternAutomaton(pattern).get_spellings()), matches)
+
+    def test_count_spellings(self):
+        self.assertEqual(PatternAutomaton('*(великая) 2я мировая война').count_spellings(), 24)
+        self.assertEqual(PatternAutomaton(' '.join(['(абвгде)'] * 20)).count_spellings(), 6 ** 20)
+
+    def test_match_equals_spellings_scan(self):
+        rng = random.Random(0)
+        patterns = ['(река) волга', 'иоганн себастьян бах = 3 13 23', '*(великая) 2я мировая война', 'xx(i)ii аа(б)']
+        for pattern in patterns:
+            automaton = PatternAutomaton(pattern)
+            spellings = set(automaton.get_spellings())
+            texts = {''.join(rng.choice('авбгiкх2я') for _ in range(rng.randint(0, 6))) for _ in range(200)}
+            for spelling in spellings:
+                for position in range(len(spelling) + 1):
+                    texts.update({
+                        spelling[:position] + spelling[position + 1:],
+                        spelling[:position] + 'б' + spelling[position:],
+                        spelling[:position] + 'б' + spelling[position + 1:],
+                        spelling[:position] + spelling[position + 1:position + 2] + spelling[position:position + 1] +
+                        spelling[position + 2:],
+                        spelling[:position] + 'бб' + spelling[position + 1:],
+                    })
+            for text in texts:
+                with self.subTest(pattern=pattern, text=text):
+                    self.assertEqual(automaton.match(text, max_edits=0), text in spellings)
+                    self.assertEqual(
+                        automaton.match(text),
+                        any(jellyfish.damerau_levenshtein_distance(spelling, text) <= 1 for spelling in spellings)
+                    )
+
+    def test_match_covers_expansion_with_odd_words(self):
+        # Every text close to an expanded key matches; skipping odd words at any occurrence may match a few more
+        rng = random.Random(0)
+        alphabet = 'абв2i'
+        for _ in range(300):
+            items = []
+            for _ in range(rng.randint(1, 3)):
+                item = ''.join(rng.choice(alphabet) for _ in range(rng.randint(1, 3)))
+                if rng.random() < 0.4:
+                    item += f'({rng.choice("аxб")})'
+                items.append(f'*{item}' if rng.random() < 0.3 else item)
+            pattern = ' '.join(items)
+            odd_words = tuple(
+                ''.join(rng.choice(alphabet) for _ in range(rng.randint(1, 2))) for _ in range(rng.randint(1, 2))
+            )
+            normalizer = Normalizer(odd_words)
+            automaton = PatternAutomaton(pattern)
+            keys = {normalizer.remove_odd_words(spelling) for spelling in automaton.get_spellings()} - {''}
+            texts = set()
+            for key in keys:
+                for position in range(len(key) + 1):
+                    texts.update({
+                        key,
+                        key[:position] + key[position + 1:],
+                        key[:position] + rng.choice(alphabet) + key[position:],
+                        key[:position] + rng.choice(alphabet) + key[position + 1:],
+                        key[:position] + key[position + 1:position + 2] + key[position:position + 1] +
+                        key[position + 2:],
+                    })
+            for text in {normalizer.simplify(text) for text in texts} - {''}:
+                with self.subTest(pattern=pattern, odd_words=odd_words, text=text):
+                    if text in keys:
+                        self.assertTrue(automaton.match(text, odd_words, max_edits=0))
+                    if any(jellyfish.damerau_levenshtein_distance(key, text) <= 1 for key in keys):
+                        self.assertTrue(automaton.match(text, odd_words))
+        automaton = PatternAutomaton('*22вб(а) *бiа *в2(x)')
+        self.assertTrue(automaton.match('б2i', ('ав',)))
+
+    @staticmethod
+    def skip_odd_words(spelling: str, odd_words: tuple[str, ...]) -> set[str]:
+        # Every text left after removing any set of non-overlapping odd word occurrences of the spelling
+        texts = {''}
+        texts_by_position = {len(spelling): texts}
+        for position in range(len(spelling) - 1, -1, -1):
+            skipped = set()
+            for word in odd_words:
+                if spelling.startswith(word, position):
+                    skipped |= texts_by_position[position + len(word)]
+            texts = {spelling[position] + text for text in texts} | skipped
+            texts_by_position[position] = texts
+        return texts
+
+    def test_match_accepts_odd_words_skipped_at_any_occurrence(self):
+        # The accepted superset of the expansion: odd words are skipped at any of their occurrences,
+        # while the expansion removes them word by word with str.replace
+        automaton = PatternAutomaton('в вбi ii')
+        self.assertEqual(automaton.get_spellings(), ['вбiii'])
+        self.assertEqual(Normalizer(('бi', 'i')).remove_odd_words('вбiii'), 'в')
+        self.assertTrue(automaton.match('вб', ('бi', 'i'), max_edits=0))
+        self.assertTrue(automaton.match('2б', ('бi', 'i')))
+        automaton = PatternAutomaton('вбв(x) 2б2')
+        self.assertEqual(Normalizer(('б', 'б2')).remove_odd_words('вбв2б2'), 'вв22')
+        self.assertTrue(automaton.match('вв2', ('б', 'б2'), max_edits=0))
+        self.assertTrue(automaton.match('в2', ('б', 'б2')))
+        rng = random.Random(0)
+        for _ in range(300):
+            pattern = ' '.join(
+                ''.join(rng.choice('абв2i') for _ in range(rng.randint(1, 3))) + rng.choice(['', '(а)', '(б)'])
+                for _ in range(rng.randint(1, 3))
+            )
+            odd_words = tuple(
+                ''.join(rng.choice('абв2i') for _ in range(rng.randint(1, 2))) for _ in range(rng.randint(1, 2))
+            )
+            automaton = PatternAutomaton(pattern)
+            accepted = set().union(
+                *(self.skip_odd_words(spelling, odd_words) for spelling in automaton.get_spellings())
+            )
+            texts = {''.join(rng.choice('абв2i') for _ in range(rng.randint(0, 5))) for _ in range(30)} | accepted
+            for text in texts:
+                with self.subTest(pattern=pattern, odd_words=odd_words, text=text):
+                    self.assertEqual(automaton.match(text, odd_words, max_edits=0), text in accepted)
+                    self.assertEqual(
+                        automaton.match(text, odd_words),
+                        any(jellyfish.damerau_levenshtein_distance(key, text) <= 1 for key in accepted)
+                    )
+
+
+class RoundFinishTest(TransactionTestCase):
+
+    def setUp(self):
+        clear_leaderboard()
+        self.topic = Topic.objects.create(title='Реки')
+        self.players = [create_player(i) for i in range(2)]
+
+    def test_finish_matches_full_recount(self):
+        rng = random.Random(0)
+        player, guest = self.players
+        for i in range(12):
+            topic = Topic.objects.create(title=f'Тема {i}')
+            duel = i % 3 == 0
+            round_ = Round.objects.create(
+                player1=self.players[i % 2] if not duel else player,
+                player2=guest if duel else None,
+                topic=topic,
+                duel=duel,
+                hits_mode=i % 2 == 0
+            )
+            round_.finish(*(rng.randint(0, 30) for _ in range(2)), *(rng.randint(0, 3) for _ in range(2)))
+        fields = [
+            'score_sum', 'rounds_count', 'average_score', 'victories', 'defeats', 'draws', 'rating', 'level',
+            'duel_score_sum', 'duel_rounds_count', 'duel_average_score', 'duel_victories', 'duel_defeats',
+            'duel_draws'
+        ]
+        for player in self.players:
+            player.refresh_from_db()
+            counters = [getattr(player, field) for field in fields]
+            player.update_statistics(full=True)
+            self.assertEqual(counters, [getattr(player, field) for field in fields])
+
+    def test_rating_fades_with_age(self):
+        player = self.players[0]
+        now = timezone.now()
+        expected = 0
+        rounds = [(0, 12, 5), (1, 7, 7), (5, 3, 9), (20, 20, 1), (33, 8, 2), (34, 9, 1), (50, 5, 0)]
+        for days, score1, score2 in rounds:
+            topic = Topic.objects.create(title=f'Тема {days}')
+            Round.objects.create(
+                player1=player, topic=topic, score1=score1, score2=score2,
+                finished_at=now - timezone.timedelta(days=days)
+            )
+            bonus = 40 if score1 > score2 else 20 if score1 == score2 else 0
+            expected += (score1 + bonus) * max(0, 1 - days*0.03)
+        self.assertAlmostEqual(player.get_rating(), expected)
+
+    def test_batch_ratings_equal_per_player(self):
+        rng = random.Random(0)
+        topics = [Topic.objects.create(title=f'Тема {i}') for i in range(15)]
+        players = self.players + [create_player(i) for i in range(2, 6)]
+        now = timezone.now()
+        for player in players[1:]:
+            for topic in rng.sample(topics, rng.randint(0, 15)):
+                Round.objects.create(
+                    player1=player, topic=topic, score1=rng.randint(0, 30), score2=rng.randint(0, 30),
+                    finished_at=now - timezone.timedelta(days=rng.randint(0, 40), hours=rng.randint(0, 23))
+                )
+            player.average_score = rng.randint(0, 45)
+            player.save()
+        self.assertTrue(Player.update_ratings(chunk_size=2))
+        self.assertEqual(Player.update_ratings(chunk_size=2), 0)
+        for player in players:
+            player.refresh_from_db()
+            self.assertEqual(player.rating, round(player.get_rating()))
+            self.assertEqual(player.level, Player.get_level(player.average_score, 3))
+            self.assertEqual(player.position, Player.objects.filter(rating__gt=player.rating).count() + 1)
+
+    def test_topic_score_sums(self):
+        for player, score in zip(self.players, (30, 10)):
+            round_ = Round.objects.create(player1=player, topic=self.topic)
+            stale_round = Round.objects.get(id=round_.id)
+            rating, position, _, _ = round_.finish(score, 5)
+            self.assertEqual(rating, score + 40)
+            self.assertEqual(stale_round.finish(score, 5), (0, 0, 0, 0))
+        self.assertEqual(position, 2)
+        self.topic.refresh_from_db()
+        self.assertEqual((self.topic.score_sum, self.topic.rounds_count, self.topic.average_score), (40, 2, 20))
+        self.topic.update_statistics()
+        self.assertEqual((self.topic.score_sum, self.topic.rounds_count, self.topic.average_score), (40, 2, 20))
+
+    def test_concurrent_finish_counts_once(self):
+        player, guest = self.players
+        round_ = Round.objects.create(player1=player, player2=guest, topic=self.topic, duel=True)
+        stale_round = Round.objects.get(id=round_.id)
+        self.assertEqual(round_.finish(20, 10), (0, 1, 0, 1))
+        self.assertEqual(stale_round.finish(20, 10), (0, 0, 0, 0))
+        for player, score_sum, duel_rating in zip(self.players, (20, 10), (1016, 984)):
+            player.refresh_from_db()
+            self.assertEqual((player.duel_score_sum, player.duel_rounds_count), (score_sum, 1))
+            self.assertEqual(player.duel_victories + player.duel_defeats, 1)
+            self.assertEqual(player.duel_rating, duel_rating)
+
+    def test_duel_elo_ratings(self):
+        player, guest = self.players
+        player.rating = 30
+        player.save()
+        round_ = Round.objects.create(player1=player, player2=guest, topic=self.topic, duel=True)
+        response = self.client.post(
+            '/api/game/finish',
+            {'round_id': round_.id, 'score1': 20, 'score2': 10},
+            content_type='application/json'
+        )
+        # The regular rating stays as it was, the duel one changes
+        self.assertEqual(response.json(), {
+            'rating1': 30, 'position1': 1, 'rating2': 0, 'position2': 2,
+            'duel_rating1': 1016, 'duel_position1': 1, 'duel_rating2': 984, 'duel_position2': 2
+        })
+        rng = random.Random(0)
+        for i in range(10):
+            players = rng.sample(self.players, 2)
+            topic = Topic.objects.create(title=f'Тема {i}')
+            round_ = Round.objects.create(player1=players[0], player2=players[1], topic=topic, duel=True)
+            round_.finish(rng.randint(0, 30), rng.randint(0, 30))
+        ratings = [Player.objects.get(id=player.id).duel_rating for player in self.players]
+        self.assertEqual(sum(ratings), 2000)
+        Player.objects.update(duel_rating=1000)
+        self.assertEqual(Player.replay_duel_ratings(chunk_size=3), 2)
+        self.assertEqual([Player.objects.get(id=player.id).duel_rating for player in self.players], ratings)
+        self.assertEqual(Player.objects.top(2, field='duel_rating')[0].duel_rating, max(ratings))
+
+
+class FakeRedis:
+    # The sorted set commands RedisLeaderboard uses, over plain dicts
+    def __init__(self):
+        self.sets: dict[str, dict[bytes, float]] = {}
+
+    def exists(self, key: str) -> int:
+        return int(key in self.sets)
+
+    def delete(self, key: str) -> None:
+        self.sets.pop(key, None)
+
+    def rename(self, key: str, new_key: str) -> None:
+        self.sets[new_key] = self.sets.pop(key)
+
+    def zadd(self, key: str, mapping: dict[int, int]) -> None:
+        self.sets.setdefault(key, {}).update({str(member).encode(): float(score) for member, score in mapping.items()})
+
+    def zrem(self, key: str, member: int) -> None:
+        self.sets.get(key, {}).pop(str(member).encode(), None)
+        if key in self.sets and not self.sets[key]:
+            del self.sets[key]
+
+    def zcount(self, key: str, min_score: str, max_score: str) -> int:
+        assert min_score.startswith('(') and max_score == '+inf'
+        return sum(score > float(min_score[1:]) for score in self.sets.get(key, {}).values())
+
+    def zrevrange(self, key: str, start: int, end: int) -> list[bytes]:
+        members = sorted(self.sets.get(key, {}).items(), key=lambda item: (item[1], item[0]), reverse=True)
+        return [member for member, _ in members[start:end + 1]]
+
+    def zscan_iter(self, key: str):
+        return iter(list(self.sets.get(key, {}).items()))
+
+
+class LeaderboardTest(SimpleTestCase):
+
+    def check_rank_and_top(self, leaderboard: LocalLeaderboard | RedisLeaderboard):
+        rng = random.Random(0)
+        leaderboard.replace({player_id: rng.randint(0, 40) for player_id in range(1, 30)})
+        ratings = leaderboard.items()
+        for _ in range(500):
+            player_id = rng.randint(1, 60)
+            if rng.random() < 0.1:
+                leaderboard.remove(player_id)
+                ratings.pop(player_id, None)
+            else:
+                ratings[player_id] = rng.randint(0, 40)
+                leaderboard.set(player_id, ratings[player_id])
+        self.assertTrue(leaderboard.exists())
+        for rating in range(-1, 42):
+            self.assertEqual(leaderboard.rank(rating), sum(r > rating for r in ratings.values()) + 1)
+        top = leaderboard.top(10)
+        self.assertEqual([ratings[player_id] for player_id in top], sorted(ratings.values(), reverse=True)[:10])
+        self.assertEqual(leaderboard.items(), ratings)
+        leaderboard.replace({})
+        self.assertFalse(leaderboard.exists())
+        self.assertEqual(leaderboard.rank(0), 1)
+
+    def test_rank_and_top_equal_sorting(self):
+        self.check_rank_and_top(LocalLeaderboard())
+
+    def test_redis_rank_and_top_equal_sorting(self):
+        with mock.patch('redis.Redis.from_url', return_value=FakeRedis()):
+            leaderboard = RedisLeaderboard('redis://localhost')
+        self.check_rank_and_top(leaderboard)
+        leaderboard.set_many({1: 5, 2: 7})
+        self.assertEqual((leaderboard.top(2), leaderboard.rank(5)), ([2, 1], 2))
+        self.assertEqual(list(leaderboard.redis.sets), ['leaderboard:rating'])
+
+
+class AnswerCountsTest(TestCase):
+
+    def test_buffered_counts_are_flushed_and_reconciled(self):
+        clear_answer_counts()
+        topic = Topic.objects.create(title='Реки')
+        topic_entities = [
+            TopicEntity.objects.create(
+                topic=topic,
+                entity=Entity.objects.create(title=f'Река {i}', pattern=f'река {i}'),
+                initial_count=i,
+                answers_count=i
+            )
+            for i in range(4)
+        ]
+        topic.update_entities_positions()
+        for i in range(4):
+            player = create_player(i)
+            round_ = Round.objects.create(player1=player, topic=topic)
+            with self.captureOnCommitCallbacks(execute=True):
+                Answer.get_or_create(round=round_, topic_entity=topic_entities[0], text='волга')
+                Answer.get_or_create(round=round_, topic_entity=topic_entities[0], text='волга')
+                Answer.get_or_create(round=round_, topic_entity=topic_entities[1], text='ока', player=2)
+        # Without a shared buffer every commit is flushed right away
+        topic_entities[0].refresh_from_db()
+        self.assertEqual((topic_entities[0].answers_count, topic_entities[0].position), (4, 1))
+        self.assertEqual(TopicEntity.flush_answer_counts(), 0)
+        self.assertEqual(topic.reconcile_answers_counts(), 0)
+        TopicEntity.objects.filter(id=topic_entities[0].id).update(answers_count=1)
+        self.assertEqual(topic.reconcile_answers_counts(), 1)
+        topic_entities[0].refresh_from_db()
+        self.assertEqual((topic_entities[0].answers_count, topic_entities[0].position), (4, 1))
+        # A failed flush keeps its counts for the next one
+        get_answer_counts().add(topic_entities[2].id, 5)
+        with mock.patch.object(TopicEntity, 'increment_answers_count', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                TopicEntity.flush_answer_counts()
+        self.assertEqual(TopicEntity.flush_answer_counts(), 1)
+        topic_entities[2].refresh_from_db()
+        self.assertEqual((topic_entities[2].answers_count, topic_entities[2].position), (7, 1))
+
+
+class EntityPositionsTest(TestCase):
+
+    def setUp(self):
+        clear_answer_counts()
+        self.topic = Topic.objects.create(title='Реки')
+        self.topic_entities = [
+            TopicEntity.objects.create(
+                topic=self.topic,
+                entity=Entity.objects.create(title=f'Река {i}', pattern=f'река {i}'),
+                answers_count=10 - i
+            )
+            for i in range(10)
+        ]
+        self.topic.update_entities_positions()
+
+    def get_positions(self) -> list[tuple[int, int]]:
+        return list(self.topic.topic_entities.order_by('position').values_list('id', 'answers_count'))
+
+    def test_flush_shifts_only_overtaken_range(self):
+        self.topic.refresh_from_db()
+        positions_version = self.topic.positions_version
+        get_answer_counts().add(self.topic_entities[7].id, 5)
+        # The overtaken entities move down in one UPDATE and the entity itself in another; nothing is re-sorted
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(TopicEntity.flush_answer_counts(), 1)
+        updates = [query['sql'] for query in queries if query['sql'].startswith('UPDATE "game_topicentity"')]
+        self.assertEqual(len(updates), 2)
+        self.assertFalse(any('CASE' in sql for sql in updates))
+        ids = [topic_entity.id for topic_entity in self.topic_entities]
+        self.assertEqual(
+            self.get_positions(),
+            [(topic_entity_id, 10 - i) for i, topic_entity_id in enumerate(ids[:3])] + [(ids[7], 8)] +
+            [(topic_entity_id, 7 - i) for i, topic_entity_id in enumerate(ids[3:7])] + [(ids[8], 2), (ids[9], 1)]
+        )
+        self.topic.refresh_from_db()
+        self.assertEqual(self.topic.positions_version, positions_version + 1)
+
+    def test_flushed_positions_equal_full_sort(self):
+        rng = random.Random(0)
+        for _ in range(30):
+            for topic_entity in rng.sample(self.topic_entities, rng.randint(1, 4)):
+                get_answer_counts().add(topic_entity.id, rng.randint(1, 3))
+            TopicEntity.flush_answer_counts()
+            positions = self.get_positions()
+            self.assertEqual(
+                list(self.topic.topic_entities.order_by('position').values_list('position', flat=True)),
+                list(range(1, 11))
+            )
+            self.topic.update_entities_positions()
+            self.assertEqual(self.get_positions(), positions)
+        # An entity added since the last sort makes the flush re-sort the topic
+        topic_entity = TopicEntity.objects.create(
+            topic=self.topic, entity=Entity.objects.create(title='Волга', pattern='волга')
+        )
+        get_answer_counts().add(topic_entity.id, 1)
+        TopicEntity.flush_answer_counts()
+        topic_entity.refresh_from_db()
+        self.assertEqual(topic_entity.position, 11)
+
+
+class AnswerSubmissionTest(TestCase):
+
+    def setUp(self):
+        self.topic = create_topic('Реки', {title: title.lower() for title in ['Волга', 'Ока', 'Дон', 'Лена', 'Обь']})
+        self.topic.bot_answers = json.dumps(
+            {te.id: te.entity.title for te in self.topic.topic_entities.select_related('entity')},
+            ensure_ascii=False
+        )
+        self.topic.save()
+        player = create_player()
+        self.round = Round.objects.create(player1=player, topic=self.topic)
+        clear_bot_samplers()
+        get_bot_sampler(self.topic, Config.bot_sampler_ttl)
+
+    def post_answer(self, text: str):
+        return self.client.post(
+            '/api/game/answer',
+            {'round_id': self.round.id, 'answer': text},
+            content_type='application/json'
+        )
+
+    def test_lock_covers_round_row_only(self):
+        with mock.patch('game.models.get_object_or_404', wraps=get_object_or_404) as get_round:
+            with transaction.atomic():
+                self.assertEqual(Round.lock(self.round.id), self.round)
+        query = get_round.call_args.args[0].query
+        self.assertTrue(query.select_for_update)
+        self.assertEqual(query.select_for_update_of, ('self',))
+        self.assertEqual(query.select_related, {'topic': {}, 'player1': {}})
+
+    def test_match_batch_size_is_capped(self):
+        items = [{'topic_id': self.topic.id, 'text': 'волга'}] * (Config.max_match_batch_size + 1)
+        response = self.client.post('/api/game/match', {'items': items}, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post('/api/game/match', {'items': items[1:]}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), Config.max_match_batch_size)
+
+    def test_scored_answer_query_budget(self):
+        # Round lock, match, answer check and insert, bot answer check and insert, round update
+        # and the savepoint pair of the transaction
+        with self.assertNumQueries(9):
+            response = self.post_answer('Волга')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['entities'][0]['title'], 'Волга')
+        self.round.refresh_from_db()
+        self.assertEqual(self.round.attempt, 3)
+        self.assertEqual(self.round.answers.count(), 2)
+        used_topic_entities = self.round.get_used_topic_entities()
+        self.assertEqual(len(used_topic_entities), 2)
+        self.assertIn(response.json()['entities'][0]['id'], used_topic_entities)
+        self.assertIn(response.json()['chatgpt_answer']['entity']['id'], used_topic_entities)
+
+    def test_bot_answer_has_current_position(self):
+        # Positions changed by a counter flush or a re-sort rebuild the sampler and reach the bot's answer
+        sampler = get_bot_sampler(self.topic, Config.bot_sampler_ttl)
+        self.topic.topic_entities.update(position=F('position') + 5)
+        self.topic.bump_positions_version()
+        self.topic.refresh_from_db()
+        self.assertIsNot(get_bot_sampler(self.topic, Config.bot_sampler_ttl), sampler)
+        response = self.post_answer('Волга')
+        entity = response.json()['chatgpt_answer']['entity']
+        bot_answer = self.round.answers.get(player=2)
+        self.assertEqual(bot_answer.position, TopicEntity.objects.get(id=entity['id']).position)
+        self.assertGreater(bot_answer.position, 5)
+
+    def test_repeated_answer_is_declined_with_one_insert(self):
+        self.post_answer('Волга')
+        # Round lock, match, answer check, declined answer insert, attempt update and the savepoint pair
+        with self.assertNumQueries(7):
+            response = self.post_answer('Волга')
+        self.assertEqual(response.status_code, 403)
+        self.round.refresh_from_db()
+        self.assertEqual(self.round.attempt, 4)
+        self.assertEqual(
+            list(self.round.declined_answers.values_list('text', 'entity_title')),
+            [('Волга', 'Волга')]
+        )
+
+
+class MatchAnswersTest(TestCase):
+
+    def setUp(self):
+        self.rivers = create_topic('Реки', {'Волга': 'волга', 'Ока': 'ока'})
+        self.lakes = create_topic('Озёра', {'Байкал': 'байкал', 'Онега': 'онега'})
+
+    def test_bulk_matches_equal_single_matches(self):
+        items = [
+            (self.rivers.id, 'Волга'), (self.lakes.id, 'байкал'), (self.rivers.id, 'Байкал'),
+            (self.lakes.id, 'онегаа'), (0, 'волга'), (self.rivers.id, 'Волга')
+        ]
+        matches = Topic.get_matching_entities_bulk(items)
+        self.assertEqual(
+            [[topic_entity.entity.title for topic_entity in topic_entities] for topic_entities in matches],
+            [['Волга'], ['Байкал'], [], ['Онега'], [], ['Волга']]
+        )
+        topics = {self.rivers.id: self.rivers, self.lakes.id: self.lakes}
+        for (topic_id, text), topic_entities in zip(items, matches):
+            if topic_id in topics:
+                self.assertEqual(topic_entities, topics[topic_id].get_matching_entities(text) or [])
+
+    def test_apply_binds_unbound_answers(self):
+        round_ = Round.objects.create(player1=create_player(), topic=self.rivers)
+        volga = Answer.objects.create(round=round_, text='волгаа')
+        don = Answer.objects.create(round=round_, text='дон')
+        stdout = io.StringIO()
+        with contextlib.redirect_stderr(io.StringIO()):
+            call_command('match_answers', '--apply', stdout=stdout)
+        self.assertIn('Matched: 1, ambiguous: 0, bound: 1', stdout.getvalue())
+        volga.refresh_from_db()
+        don.refresh_from_db()
+        self.assertEqual(volga.topic_entity, self.rivers.topic_entities.get(entity__title='Волга'))
+        self.assertIsNone(don.topic_entity)
+        self.assertEqual(volga.topic_entity.answers_count, 1)
+
+
+class RematchTest(TestCase):
+
+    def test_only_unambiguous_answers_are_bound(self):
+        topic = create_topic('Реки', {'Волга': 'волга', 'Ока': 'ока', 'Око': 'око'})
+        player, guest = [create_player(i) for i in range(2)]
+        round_ = Round.objects.create(player1=player, topic=topic)
+        duel_round = Round.objects.create(player1=player, player2=guest, topic=topic, duel=True)
+        Answer.objects.bulk_create([
+            Answer(round=round_, text='волгаа'),
+            Answer(round=round_, text='волга'),
+            Answer(round=round_, text='оку'),
+            Answer(round=round_, text='окаа', player=2),
+            Answer(round=duel_round, text='окаа', player=2),
+            Answer(round=duel_round, text='дон'),
+        ])
+        with mock.patch.object(
+            Topic, 'update_entities_positions', autospec=True, side_effect=Topic.update_entities_positions
+        ) as update_entities_positions:
+            self.assertEqual(topic.rematch_unbound_answers(chunk_size=2), 3)
+        # The chunk whose only binding is the bot's solo answer changes no counts
+        self.assertEqual(update_entities_positions.call_count, 2)
+        self.assertEqual(
+            [answer.topic_entity and answer.topic_entity.entity.title for answer in Answer.objects.order_by('id')],
+            ['Волга', None, None, 'Ока', 'Ока', None]
+        )
+        self.assertEqual(
+            dict(topic.topic_entities.values_list('entity__title', 'answers_count')),
+            {'Волга': 1, 'Ока': 1, 'Око': 0}
+        )
+        self.assertEqual(topic.reconcile_answers_counts(), 0)
+        self.assertEqual(topic.rematch_unbound_answers(), 0)
+
+
+class JobTest(TestCase):
+
+    def test_waiting_job_absorbs_same_key(self):
+        enqueue('rematch_unbound_answers', 1, key='rematch-topic-1')
+        enqueue('rematch_unbound_answers', 1, key='rematch-topic-1')
+        enqueue('rematch_unbound_answers', 2, key='rematch-topic-2')
+        enqueue('flush_answer_counts')
+        enqueue('flush_answer_counts')
+        self.assertEqual(
+            list(Job.objects.order_by('id').values_list('key', 'args')),
+            [('rematch-topic-1', '[1]'), ('rematch-topic-2', '[2]'), ('', '[]'), ('', '[]')]
+        )
+
+    def test_failed_job_is_retried_with_backoff(self):
+        topic = Topic.objects.create(title='Реки')
+        enqueue('rematch_unbound_answers', topic.id, key=f'rematch-topic-{topic.id}')
+        with mock.patch.object(Topic, 'rematch_unbound_answers', side_effect=DatabaseError):
+            for attempts in range(1, MAX_ATTEMPTS + 1):
+                with self.assertLogs('game.jobs', 'ERROR'):
+                    self.assertTrue(run_next())
+                job = Job.objects.get()
+                self.assertEqual((job.attempts, job.failed), (attempts, attempts == MAX_ATTEMPTS))
+                delay = (job.run_after - timezone.now()).total_seconds()
+                self.assertAlmostEqual(delay, RETRY_DELAY * 2**attempts, delta=5)
+                self.assertFalse(run_next())
+                Job.objects.update(run_after=timezone.now())
+        self.assertFalse(run_next())
+        # A failed job no longer absorbs new ones
+        enqueue('rematch_unbound_answers', topic.id, key=f'rematch-topic-{topic.id}')
+        self.assertTrue(run_next())
+        self.assertEqual(list(Job.objects.values_list('failed', flat=True)), [True])
+
+
+class BotSamplerTest(SimpleTestCase):
+
+    def test_alias_table_follows_weights(self):
+        rng = random.Random(0)
+        weights = [1, 2, 3, 4, 10, 0.5]
+        table = AliasTable(weights)
+        draws = [0] * len(weights)
+        for _ in range(100000):
+            draws[table.draw(rng)] += 1
+        for weight, count in zip(weights, draws):
+            self.assertAlmostEqual(count / 100000, weight / sum(weights), delta=0.01)
+
+    def test_choose_skips_used_entities(self):
+        rng = random.Random(0)
+        chatgpt_tier = [(f'ответ {i}', i, i * 10) for i in range(1, 6)]
+        popular_tier = [(f'река {i}', i, i * 10) for i in range(4, 9)]
+        sampler = BotSampler((), [chatgpt_tier, popular_tier])
+        excluded_ids = set()
+        chosen = []
+        for _ in range(8):
+            text, topic_entity_id = sampler.choose(1, excluded_ids, rng)
+            self.assertNotIn(topic_entity_id, excluded_ids)
+            excluded_ids.add(topic_entity_id)
+            chosen.append(text.split()[0])
+        self.assertEqual(chosen, ['ответ'] * 5 + ['река'] * 3)
+        with self.assertRaises(IndexError):
+            sampler.choose(1, excluded_ids, rng)
+
+
+class TopicPoolTest(TestCase):
+
+    def test_sample_is_uniform_over_allowed_topics(self):
+        rng = random.Random(0)
+        pool = TopicPool([(topic_id % 10 * 5, topic_id) for topic_id in range(1, 41)])
+        excluded_ids = set(range(1, 41, 3))
+        allowed_ids = [
+            topic_id for topic_id in range(1, 41) if topic_id not in excluded_ids and 10 <= topic_id % 10 * 5 <= 30
+        ]
+        draws = dict.fromkeys(allowed_ids, 0)
+        for _ in range(20000):
+            ids = pool.sample(3, excluded_ids, 10, 30, rng)
+            self.assertEqual(len(set(ids)), 3)
+            for topic_id in ids:
+                draws[topic_id] += 1
+        self.assertEqual(set(draws), set(allowed_ids))
+        for count in draws.values():
+            self.assertAlmostEqual(count / 60000, 1 / len(allowed_ids), delta=0.005)
+        self.assertEqual(sorted(pool.sample(30, excluded_ids, 10, 30, rng)), allowed_ids)
+        self.assertEqual(pool.sample(3, excluded_ids, 46, 50, rng), [])
+
+    def test_get_random_keeps_level_and_exclusions(self):
+        clear_topic_pool()
+        player, guest = [create_player(i) for i in range(2)]
+        topics = [Topic.objects.create(title=f'Тема {i}', average_score=i * 3) for i in range(15)]
+        for i, topic in enumerate(topics[::4]):
+            response = self.client.post(
+                '/api/game/round',
+                {'player1_id': player.id, 'player2_id': guest.id if i % 2 else 0, 'topic_id': topic.id},
+                content_type='application/json'
+            )
+            self.assertEqual(response.status_code, 200)
+        player.refresh_from_db()
+        guest.refresh_from_db()
+        played_ids = player.get_played_topic_ids()
+        self.assertEqual(played_ids, {topic.id for topic in topics[::4]})
+        self.assertEqual(guest.played_topics, f'{topics[4].id} {topics[12].id}')
+        # Saves of an instance loaded before a round started keep the appended topic
+        stale_player = Player.objects.get(id=player.id)
+        Round.objects.create(player1=player, topic=topics[1]).add_to_played_topics()
+        stale_player.update_statistics()
+        stale_player.update_statistics(full=True)
+        stale_player.name = 'Игрок 0 (новое имя)'
+        stale_player.save(update_fields=['name'])
+        player.refresh_from_db()
+        self.assertEqual(player.get_played_topic_ids(), played_ids | {topics[1].id})
+        self.assertEqual(player.name, 'Игрок 0 (новое имя)')
+        suitable_ids = set(Topic.objects.for_level(4).exclude(id__in=played_ids).values_list('id', flat=True))
+        for _ in range(20):
+            random_topics = Topic.get_random(3, played_ids, [4])
+            self.assertEqual(len(random_topics), 3)
+            self.assertLessEqual({topic.id for topic in random_topics}, suitable_ids)
+        # Too few topics of the level, so any unplayed ones are offered
+        random_topics = Topic.get_random(3, played_ids, [0, 4])
+        self.assertEqual(len(random_topics), 3)
+        self.assertFalse({topic.id for topic in random_topics} & played_ids)
+
+
+class TopicOffersTest(TestCase):
+
+    def setUp(self):
+        clear_topic_offers()
+        clear_topic_pool()
+        self.player = create_player()
+        self.topics = [Topic.objects.create(title=f'Тема {i}', average_score=10) for i in range(10)]
+
+    def get_random_topics(self) -> list[int]:
+        response = self.client.get('/api/game/random-topics', {'player1_id': self.player.id})
+        self.player.clear_assigned_topics()
+        return [topic['id'] for topic in response.json()]
+
+    def test_offers_are_prepared_after_round_start(self):
+        # Without Redis nothing is left to the job worker, whose memory the web workers could not see
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(
+                '/api/game/round',
+                {'player1_id': self.player.id, 'player2_id': 0, 'topic_id': self.topics[0].id},
+                content_type='application/json'
+            )
+        self.assertFalse(run_next())
+        # Player lookup and assigned topics update only
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/game/random-topics', {'player1_id': self.player.id})
+        self.player.clear_assigned_topics()
+        topic_ids = [topic['id'] for topic in response.json()]
+        self.assertEqual(len(set(topic_ids)), 3)
+        self.assertNotIn(self.topics[0].id, topic_ids)
+        Round.objects.create(player1=self.player, topic_id=topic_ids[0]).add_to_played_topics()
+        self.player.refresh_from_db()
+        # The remaining offer is skipped if it includes the topic played since it was prepared
+        topic_ids = self.get_random_topics()
+        self.assertEqual(len(topic_ids), 3)
+        self.assertFalse(self.player.get_played_topic_ids() & set(topic_ids))
+
+    def test_missing_offers_are_prepared_after_response(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertIsNone(self.player.pop_topic_offer())
+        self.assertIsNone(self.player.pop_topic_offer())
+        request_finished.send(sender=None)
+        self.assertEqual(len(self.player.pop_topic_offer()), 3)
+        self.assertEqual(len(self.player.pop_topic_offer()), 3)
+        # The request that found no offer returns the sampled topics, and the next ones follow it
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(len(self.get_random_topics()), 3)
+        self.assertIsNone(get_topic_offers(Config.topic_offers_ttl).pop(self.player.id))
+        request_finished.send(sender=None)
+        self.assertEqual(len(self.player.pop_topic_offer()), 3)
+
+    def test_new_topic_drops_offers(self):
+        self.player.fill_topic_offers()
+        with self.captureOnCommitCallbacks(execute=True):
+            Topic.objects.create(title='Новая тема')
+        self.assertIsNone(self.player.pop_topic_offer())
+        self.player.fill_topic_offers()
+        self.assertEqual(len(self.player.pop_topic_offer()), 3)
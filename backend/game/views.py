@@ -8,7 +8,7 @@ logger = logging.getLogger(__name__)
 
 
 class RoundListView(ListView):
-    queryset = Round.objects.filter(checked=False).select_related('topic')
+    queryset = Round.objects.filter(checked=False).select_related('topic').prefetch_related('declined_answers')
     paginate_by = 20
     template_name = 'round_list.html'
 
@@ -132,6 +132,8 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 OPENAI_KEY = env('OPENAI_KEY')
 OPENAI_ID = env('OPENAI_ID')
 
+REDIS_URL = env.str('REDIS_URL', '')
+
 CSRF_TRUSTED_ORIGINS = env.list('CSRF_TRUSTED_ORIGINS', 'http://127.0.0.1')
 
 LOGGING = {